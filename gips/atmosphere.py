@@ -28,17 +28,32 @@ Any info passed in beyond this should be via keywords
 """
 
 import os
-import sys
+import copy
 import datetime
-import commands
+import subprocess
 import tempfile
 import shutil
+import json
+import hashlib
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy
 
-from gips.utils import List2File, VerboseOut
-from gips.data.merra import merraData
-from gips.data.aod import aodData
-from Py6S import SixS, Geometry, AeroProfile, Altitudes, Wavelength, GroundReflectance, AtmosCorr, SixSHelpers
+from gips.utils import List2File, VerboseOut, mkdir
+from Py6S import SixS, Geometry, AeroProfile, Altitudes, Wavelength, GroundReflectance, AtmosCorr, \
+    PredefinedWavelengths
+
+# maximum number of model runs (e.g., bands) done at once
+numworkers = 8
+
+# predefined 6S spectral responses used instead of band wavelengths (LC8 doesn't seem to work)
+_predefined = {
+    'LT5': ['LANDSAT_TM_B1', 'LANDSAT_TM_B2', 'LANDSAT_TM_B3',
+            'LANDSAT_TM_B4', 'LANDSAT_TM_B5', 'LANDSAT_TM_B7'],
+    'LT7': ['LANDSAT_ETM_B1', 'LANDSAT_ETM_B2', 'LANDSAT_ETM_B3',
+            'LANDSAT_ETM_B4', 'LANDSAT_ETM_B5', 'LANDSAT_ETM_B7'],
+}
 
 
 class AtmCorrException(Exception):
@@ -82,72 +97,278 @@ def atmospheric_model(doy, lat):
     return model
 
 
+def _sixs(model, aod):
+    """ SixS instance with the settings used for all runs (geometry and wavelength not set) """
+    s = SixS()
+    s.altitudes = Altitudes()
+    s.altitudes.set_target_sea_level()
+    s.altitudes.set_sensor_satellite_level()
+
+    # Atmospheric profile
+    s.atmos_profile = model
+
+    # Aerosols
+    # TODO - dynamically adjust AeroProfile?
+    s.aero_profile = AeroProfile.PredefinedType(AeroProfile.Continental)
+
+    s.aot550 = aod
+
+    # Other settings
+    s.ground_reflectance = GroundReflectance.HomogeneousLambertian(GroundReflectance.GreenVegetation)
+    s.atmos_corr = AtmosCorr.AtmosCorrLambertianFromRadiance(1.0)
+    return s
+
+
+def _sixs_results(out):
+    """ Transmittance, upwelling radiance and downwelling irradiance (T, Lu, Ld) from 6S outputs """
+    t = out.trans['global_gas'].upward
+    Lu = out.atmospheric_intrinsic_radiance
+    Ld = (out.direct_solar_irradiance + out.diffuse_solar_irradiance + out.environmental_irradiance) / numpy.pi
+    return [t, Lu, Ld]
+
+
+def _run_concurrent(func, args):
+    """ Call func on each of args on up to numworkers threads, returning results in order
+    (each model run is an external process so threads are sufficient) """
+    if len(args) < 2:
+        return [func(a) for a in args]
+    pool = ThreadPool(min(numworkers, len(args)))
+    try:
+        return pool.map(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _sixs_wavelengths(sensor, wavelengths):
+    """ 6S wavelengths of bands (wvlen1, wvlen2) of sensor, the predefined spectral responses if available """
+    if sensor in _predefined:
+        return [Wavelength(getattr(PredefinedWavelengths, b)) for b in _predefined[sensor]]
+    return [Wavelength(wv[0], wv[1]) for wv in wavelengths]
+
+
+def _sixs_run(s, wavelength):
+    """ Run copy of SixS instance for a single wavelength, return outputs """
+    s = copy.deepcopy(s)
+    s.wavelength = wavelength
+    s.run()
+    return s.outputs
+
+
+def _lut_run(point):
+    """ Run 6S for a single lookup table point (6S wavelength, solarzenith, viewzenith, azimuth, aod, model, doy) """
+    wv, sz, vz, raz, aod, model, doy = point
+    s = _sixs(int(model), aod)
+    s.geometry = Geometry.User()
+    s.geometry.solar_z = sz
+    s.geometry.solar_a = 0.0
+    s.geometry.view_z = vz
+    s.geometry.view_a = raz
+    # day of year in a non-leap year
+    date = datetime.date(2001, 1, 1) + datetime.timedelta(days=int(doy) - 1)
+    s.geometry.month = date.month
+    s.geometry.day = date.day
+    s.wavelength = wv
+    s.run()
+    return _sixs_results(s.outputs)
+
+
+class SIXSLUT(object):
+    """ Lookup table of 6S results (T, Lu, Ld) for the bands of a sensor, interpolated instead of running 6S
+    (built with the same spectral responses as running 6S for the sensor) """
+    # axes of table, model is the atmospheric model (see atmospheric_model) and is not interpolated
+    axes = ['solarzenith', 'viewzenith', 'azimuth', 'aod', 'model', 'doy']
+    # default values along each axis (azimuth is relative azimuth of sun and sensor)
+    defaults = {
+        'solarzenith': [0.0, 10.0, 20.0, 30.0, 40.0, 50.0, 60.0, 70.0, 80.0],
+        'viewzenith': [0.0],
+        'azimuth': [0.0],
+        'aod': [0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 0.8, 1.2],
+        'model': [1, 2, 3, 4, 5, 6],
+        'doy': [1, 32, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335, 366],
+    }
+    # tables loaded in this process, keyed by filename
+    _luts = {}
+
+    def __init__(self, filename):
+        """ Read lookup table file """
+        f = numpy.load(filename)
+        self.filename = filename
+        # tables built before the sensor was stored used band wavelengths
+        self.sensor = str(f['sensor']) if 'sensor' in f.files else ''
+        self.bands = [str(b) for b in f['bands']]
+        self.wavelengths = f['wavelengths']
+        self.values = {a: f[a] for a in self.axes}
+        # results is bands x (T, Lu, Ld) x axes
+        self.results = f['results']
+
+    @classmethod
+    def open(cls, filename):
+        """ Return lookup table for this file (read once per process) """
+        if filename not in cls._luts:
+            cls._luts[filename] = cls(filename)
+        return cls._luts[filename]
+
+    @classmethod
+    def points(cls, sensor, wavelengths, values):
+        """ All points (6S wavelength, solarzenith, viewzenith, azimuth, aod, model, doy) in a table """
+        return list(itertools.product(_sixs_wavelengths(sensor, wavelengths), *[values[a] for a in cls.axes]))
+
+    @classmethod
+    def build(cls, filename, sensor, bands, wavelengths, numprocs=2, **kwargs):
+        """ Run 6S for bands of sensor at all points of table (kwargs override default axes values)
+        and save to filename """
+        start = datetime.datetime.now()
+        values = {a: sorted(kwargs.get(a, cls.defaults[a])) for a in cls.axes}
+        points = cls.points(sensor, wavelengths, values)
+        VerboseOut('Running 6S for %s points in lookup table' % len(points), 2)
+        pool = multiprocessing.Pool(numprocs)
+        results = pool.map(_lut_run, points, chunksize=max(1, len(points) / (numprocs * 10)))
+        pool.close()
+        pool.join()
+        shape = [len(bands)] + [len(values[a]) for a in cls.axes] + [3]
+        results = numpy.rollaxis(numpy.array(results).reshape(shape), -1, 1)
+        mkdir(os.path.dirname(os.path.abspath(filename)))
+        tmpfile = filename + '.%s.npz' % os.getpid()
+        numpy.savez(tmpfile, sensor=sensor, bands=bands, wavelengths=wavelengths, results=results,
+                    **{a: numpy.array(values[a]) for a in cls.axes})
+        os.rename(tmpfile, filename)
+        VerboseOut('Built lookup table %s in %s' % (filename, datetime.datetime.now() - start), 2)
+        return cls(filename)
+
+    def interpolate(self, bands=None, **point):
+        """ Interpolate results {band: [T, Lu, Ld]} at point (value for every axis) """
+        if bands is None:
+            bands = self.bands
+        # multilinear interpolation over all axes but model, values clamped to range of table
+        corners = []
+        for a in self.axes:
+            vals = self.values[a]
+            if a == 'model':
+                i = list(vals).index(point[a])
+                corners.append([(i, 1.0)])
+                continue
+            x = min(max(point[a], vals[0]), vals[-1])
+            i = min(max(numpy.searchsorted(vals, x) - 1, 0), max(len(vals) - 2, 0))
+            if len(vals) == 1:
+                corners.append([(0, 1.0)])
+            else:
+                w = (x - vals[i]) / float(vals[i + 1] - vals[i])
+                corners.append([(i, 1.0 - w), (i + 1, w)])
+        out = numpy.zeros(self.results.shape[0:2])
+        for corner in itertools.product(*corners):
+            weight = numpy.prod([c[1] for c in corner])
+            if weight != 0:
+                out = out + weight * self.results[(slice(None), slice(None)) + tuple([c[0] for c in corner])]
+        return {b: list(out[self.bands.index(b)]) for b in bands}
+
+    def validate(self, numpoints=20, numprocs=2, seed=None):
+        """ Compare interpolated results to 6S runs at random points
+        Returns {band: (max absolute errors, max relative errors)}, each a list for T, Lu, Ld """
+        rand = numpy.random.RandomState(seed)
+        samples = []
+        for i in range(numpoints):
+            point = {}
+            for a in self.axes:
+                vals = self.values[a]
+                if a == 'model':
+                    point[a] = vals[rand.randint(len(vals))]
+                elif a == 'doy':
+                    point[a] = rand.randint(vals[0], vals[-1] + 1)
+                else:
+                    point[a] = rand.uniform(vals[0], vals[-1])
+            samples.append(point)
+        wvs = _sixs_wavelengths(self.sensor, self.wavelengths)
+        points = [(wv,) + tuple([p[a] for a in self.axes]) for p in samples for wv in wvs]
+        pool = multiprocessing.Pool(numprocs)
+        direct = numpy.array(pool.map(_lut_run, points)).reshape((numpoints, len(self.bands), 3))
+        pool.close()
+        pool.join()
+        interp = numpy.array([[self.interpolate(**p)[b] for b in self.bands] for p in samples])
+        errors = numpy.abs(interp - direct)
+        relerrors = errors / numpy.abs(direct).clip(1e-10)
+        return {b: (list(errors[:, i, :].max(axis=0)), list(relerrors[:, i, :].max(axis=0)))
+                for i, b in enumerate(self.bands)}
+
+
 class SIXS():
     """ Class for running 6S atmospheric model """
     # TODO - genericize to move away from landsat specific
 
-    def __init__(self, bandnums, wavelengths, geometry, date_time, sensor=None):
-        """ Run SixS atmospheric model using Py6S """
+    # version of cached results, increment if model settings below change
+    _cacheversion = 1
+    # number of results read from cache, and number run, in this process
+    hits = 0
+    misses = 0
+
+    def __init__(self, bandnums, wavelengths, geometry, date_time, sensor=None, cachedir=None, lut=None):
+        """ Run SixS atmospheric model using Py6S, or read results from cache directory if already run,
+        or interpolate them from lookup table file (lut) if given """
         start = datetime.datetime.now()
         VerboseOut('Running atmospheric model (6S)', 2)
 
-        s = SixS()
+        doy = (date_time - datetime.datetime(date_time.year, 1, 1)).days + 1
+        model = atmospheric_model(doy, geometry['lat'])
+
+        # drivers imported on use so importing gips.atmosphere does not load them
+        from gips.data.aod import aodData
+        self.aod = aodData.get_aod(geometry['lat'], geometry['lon'], date_time.date())
+
+        if lut is not None and os.path.exists(lut) and SIXSLUT.open(lut).sensor != (sensor or ''):
+            VerboseOut('Lookup table %s not built for sensor %s (rebuild with gips_atmlut), running 6S'
+                       % (lut, sensor), 2)
+        elif lut is not None and os.path.exists(lut):
+            # interpolate from lookup table instead of running 6S
+            raz = abs(geometry['solarazimuth'] - geometry['azimuth']) % 360
+            self.results = SIXSLUT.open(lut).interpolate(
+                bandnums, solarzenith=geometry['solarzenith'], viewzenith=geometry['zenith'],
+                azimuth=min(raz, 360 - raz), aod=self.aod[1], model=model, doy=doy)
+            VerboseOut('Interpolated atmospheric model results from %s' % lut, 2)
+            return
+
+        if cachedir is not None:
+            inputs = [self._cacheversion, sensor, list(bandnums), [list(wv) for wv in wavelengths],
+                      [geometry[k] for k in ['lat', 'lon', 'zenith', 'azimuth']], str(date_time), model, self.aod[1]]
+            key = hashlib.sha1(json.dumps(inputs)).hexdigest()
+            cachefile = os.path.join(cachedir, key[0:2], key + '.json')
+            if os.path.exists(cachefile):
+                SIXS.hits = SIXS.hits + 1
+                self.results = json.load(open(cachefile))
+                VerboseOut('Read atmospheric model results from cache (%s hits, %s misses)' % (SIXS.hits, SIXS.misses), 2)
+                return
+            SIXS.misses = SIXS.misses + 1
+
+        s = _sixs(model, self.aod[1])
         # Geometry
         s.geometry = Geometry.User()
         s.geometry.from_time_and_location(geometry['lat'], geometry['lon'], str(date_time),
                                           geometry['zenith'], geometry['azimuth'])
-        s.altitudes = Altitudes()
-        s.altitudes.set_target_sea_level()
-        s.altitudes.set_sensor_satellite_level()
-
-        doy = (date_time - datetime.datetime(date_time.year, 1, 1)).days + 1
-        # Atmospheric profile
-        s.atmos_profile = atmospheric_model(doy, geometry['lat'])
 
-        # Aerosols
-        # TODO - dynamically adjust AeroProfile?
-        s.aero_profile = AeroProfile.PredefinedType(AeroProfile.Continental)
-
-        self.aod = AODData.get_aod(geometry['lat'], geometry['lon'], date_time.date())
-        s.aot550 = self.aod[1]
-
-        # Other settings
-        s.ground_reflectance = GroundReflectance.HomogeneousLambertian(GroundReflectance.GreenVegetation)
-        s.atmos_corr = AtmosCorr.AtmosCorrLambertianFromRadiance(1.0)
-
-        # Used for testing
+        wvs = _sixs_wavelengths(sensor, wavelengths)
         try:
-            stdout = sys.stdout
-            funcs = {
-                'LT5': SixSHelpers.Wavelengths.run_landsat_tm,
-                'LT7': SixSHelpers.Wavelengths.run_landsat_etm,
-                # LC8 doesn't seem to work
-                #'LC8': SixSHelpers.Wavelengths.run_landsat_oli
-            }
-            if sensor in funcs.keys():
-                sys.stdout = open(os.devnull, 'w')
-                wvlens, outputs = funcs[sensor](s)
-                sys.stdout = stdout
-            else:
-                # Use wavelengths
-                outputs = []
-                for wv in wavelengths:
-                    s.wavelength = Wavelength(wv[0], wv[1])
-                    s.run()
-                    outputs.append(s.outputs)
+            # each run uses its own SixS instance and temporary files so bands can run at once
+            outputs = _run_concurrent(lambda wv: _sixs_run(s, wv), wvs)
         except Exception, e:
-            sys.stdout = stdout
             raise AtmCorrException("Error running 6S: %s" % e)
 
         self.results = {}
         VerboseOut("{:>6} {:>8}{:>8}{:>8}".format('Band', 'T', 'Lu', 'Ld'), 4)
         for b, out in enumerate(outputs):
-            t = out.trans['global_gas'].upward
-            Lu = out.atmospheric_intrinsic_radiance
-            Ld = (out.direct_solar_irradiance + out.diffuse_solar_irradiance + out.environmental_irradiance) / numpy.pi
+            t, Lu, Ld = _sixs_results(out)
             self.results[bandnums[b]] = [t, Lu, Ld]
             VerboseOut("{:>6}: {:>8.3f}{:>8.2f}{:>8.2f}".format(bandnums[b], t, Lu, Ld), 4)
 
+        if cachedir is not None:
+            # write to temporary file first so other processes never read a partial file
+            try:
+                mkdir(os.path.dirname(cachefile))
+                tmpfile = '%s.%s' % (cachefile, os.getpid())
+                with open(tmpfile, 'w') as f:
+                    json.dump(self.results, f)
+                os.rename(tmpfile, cachefile)
+            except Exception, e:
+                VerboseOut('Unable to cache atmospheric model results: %s' % e, 2)
+
         VerboseOut('Ran atmospheric model in %s' % str(datetime.datetime.now() - start), 2)
 
 
@@ -173,16 +394,9 @@ class MODTRAN():
         #fout = open('atm.txt','w')
         #fout.write('{:>5}{:>20}{:>20}\n'.format('Band','%T','Radiance'))
 
-        tmpdir = tempfile.mkdtemp()
-        pwd = os.getcwd()
-        os.chdir(tmpdir)
-
-        # Create link to MODTRAN data dir
-        if not os.path.lexists('DATA'):
-            os.symlink(self._datadir, 'DATA')
-
         if profile:
-            mprofile = MerraData.profile(lon, lat, dtime)
+            from gips.data.merra import merraData
+            mprofile = merraData.profile(lon, lat, dtime)
             pressure = mprofile['pressure']
             temp = mprofile['temp']
             humidity = mprofile['humidity']
@@ -194,33 +408,41 @@ class MODTRAN():
         else:
             self.atmprofile = None
 
-        # Generate MODTRAN input files
+        # all files are written to a directory for this run only, in which modtran is run
+        self.workdir = tempfile.mkdtemp()
+        try:
+            # Create link to MODTRAN data dir
+            os.symlink(self._datadir, os.path.join(self.workdir, 'DATA'))
+
+            # Generate MODTRAN input files
 
-        # Determine if radiance or transmittance mode
-        rootnames = self.addband(bandnum, wvlen1, wvlen2)
-        List2File(rootnames, 'mod5root.in')
+            # Determine if radiance or transmittance mode
+            rootnames = self.addband(bandnum, wvlen1, wvlen2)
+            List2File(rootnames, os.path.join(self.workdir, 'mod5root.in'))
 
-        try:
             # run output and get results
-            modout = commands.getstatusoutput('modtran')
-            #VerboseOut("MODTRAN Output:", 4)
-            #[VerboseOut(m, 4) for m in modout]
-            self.output = self.readoutput(bandnum)
-            VerboseOut('MODTRAN Output: %s' % ' '.join([str(s) for s in self.output]), 4)
-        except:
-            VerboseOut(modout, 4)
-            raise AtmCorrException("Error running MODTRAN")
-
-        # Change back to original directory
-        os.chdir(pwd)
-
-        #print 'MODTRAN dir: ', tmpdir
-        # Remove directory
-        shutil.rmtree(tmpdir)
+            modout = ''
+            try:
+                proc = subprocess.Popen(['modtran'], cwd=self.workdir,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                modout = proc.communicate()[0]
+                self.output = self.readoutput(bandnum)
+                VerboseOut('MODTRAN Output: %s' % ' '.join([str(s) for s in self.output]), 4)
+            except:
+                VerboseOut(modout, 4)
+                raise AtmCorrException("Error running MODTRAN")
+        finally:
+            # Remove directory
+            shutil.rmtree(self.workdir)
+
+    @classmethod
+    def run_bands(cls, bands, dtime, lat, lon, profile=False):
+        """ Run MODTRAN for each (bandnum, wvlen1, wvlen2) in bands at once, return list of instances """
+        return _run_concurrent(lambda b: cls(b[0], b[1], b[2], dtime, lat, lon, profile), bands)
 
     def readoutput(self, bandnum):
         try:
-            f = open('band' + str(bandnum) + '.chn')
+            f = open(os.path.join(self.workdir, 'band' + str(bandnum) + '.chn'))
             lines = f.readlines()
             f.close()
             data = lines[4 + bandnum]
@@ -230,7 +452,7 @@ class MODTRAN():
             Lu = (float(data[59:72]) * 10000) / bandwidth
             trans = float(data[239:248])
             try:
-                f = open('band' + str(bandnum) + 'Ld.chn')
+                f = open(os.path.join(self.workdir, 'band' + str(bandnum) + 'Ld.chn'))
                 lines = f.readlines()
                 f.close()
                 data = lines[4 + bandnum]
@@ -264,7 +486,7 @@ class MODTRAN():
             return (rootname1,)
 
     def tape5(self, fname, mode, wvlen1, wvlen2, fwhm, surref=0, h1=100):
-        f = open(fname + '.tp5', 'w')
+        f = open(os.path.join(self.workdir, fname + '.tp5'), 'w')
         f.write(self.card1(mode=mode, surref=surref) + '\n')
         f.write(self.card1a() + '\n')
         if self.filterfile:
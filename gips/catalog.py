@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+import os
+import sqlite3
+import traceback
+from datetime import datetime
+
+from gips.utils import VerboseOut
+
+"""
+The catalog is an SQLite index of the assets and products held in a repository
+so inventories can be answered without scanning the tile/date directories.
+It is only used once it has been built (gips_catalog rebuild), until then
+the repository is read directly from disk. The modification times of the
+tile and date directories are recorded so a refresh only rescans the
+directories that have changed.
+"""
+
+
+class Catalog(object):
+    """ SQLite index of the assets and products in a single repository """
+    # name of catalog file in top level of repository
+    filename = 'catalog.db'
+    # seconds to wait on a locked database (multiple hosts archiving)
+    _timeout = 60.0
+    # date format used to store dates
+    _datefmt = '%Y-%m-%d'
+    # open catalogs, keyed by (filename, pid)
+    _catalogs = {}
+    # True while reading repository from disk to update catalog
+    scanning = False
+
+    _schema = [
+        'CREATE TABLE IF NOT EXISTS assets '
+        '(tile TEXT, date TEXT, sensor TEXT, asset TEXT, filename TEXT PRIMARY KEY)',
+        'CREATE INDEX IF NOT EXISTS assets_tile_date ON assets (tile, date)',
+        'CREATE TABLE IF NOT EXISTS products '
+        '(tile TEXT, date TEXT, sensor TEXT, product TEXT, filename TEXT, PRIMARY KEY (tile, date, sensor, product))',
+        # directory mtimes (date is NULL for tile level directories)
+        'CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, tile TEXT, date TEXT, mtime REAL)',
+        'CREATE INDEX IF NOT EXISTS dirs_tile ON dirs (tile)',
+    ]
+
+    def __init__(self, filename):
+        """ Open (and create if needed) catalog database """
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=self._timeout)
+        for sql in self._schema:
+            self.conn.execute(sql)
+        self.conn.commit()
+
+    @classmethod
+    def open(cls, filename):
+        """ Return open catalog for this file (connections are not shared across processes) """
+        key = (filename, os.getpid())
+        if key not in cls._catalogs:
+            cls._catalogs[key] = cls(filename)
+        return cls._catalogs[key]
+
+    @classmethod
+    def close(cls, filename):
+        """ Close catalog for this file if open in this process """
+        catalog = cls._catalogs.pop((filename, os.getpid()), None)
+        if catalog is not None:
+            catalog.conn.close()
+
+    def _datestr(self, date):
+        return date.strftime(self._datefmt)
+
+    def _date(self, datestr):
+        return datetime.strptime(datestr, self._datefmt).date()
+
+    ##########################################################################
+    # Queries
+    ##########################################################################
+    def dates(self, tiles):
+        """ Get sorted list of dates with any assets or products for these tiles """
+        tiles = list(tiles)
+        if len(tiles) == 0:
+            return []
+        marks = ','.join('?' * len(tiles))
+        sql = ('SELECT date FROM assets WHERE tile IN (%s) UNION SELECT date FROM products WHERE tile IN (%s)'
+               % (marks, marks))
+        return sorted([self._date(row[0]) for row in self.conn.execute(sql, tiles + tiles)])
+
+    def assets(self, tile, date, asset=None):
+        """ Get list of (asset, filename) for this tile and date """
+        sql = 'SELECT asset, filename FROM assets WHERE tile=? AND date=?'
+        args = [tile, self._datestr(date)]
+        if asset is not None:
+            sql = sql + ' AND asset=?'
+            args.append(asset)
+        return [(str(row[0]), str(row[1])) for row in self.conn.execute(sql, args)]
+
+    def products(self, tile, date):
+        """ Get list of (sensor, product, filename) for this tile and date """
+        sql = 'SELECT sensor, product, filename FROM products WHERE tile=? AND date=?'
+        rows = self.conn.execute(sql, (tile, self._datestr(date)))
+        return [(str(row[0]), str(row[1]), str(row[2])) for row in rows]
+
+    def count(self):
+        """ Number of (assets, products) in catalog """
+        nassets = self.conn.execute('SELECT COUNT(*) FROM assets').fetchone()[0]
+        nproducts = self.conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+        return (nassets, nproducts)
+
+    ##########################################################################
+    # Updates
+    ##########################################################################
+    def _insert_asset(self, tile, date, sensor, asset, filename):
+        self.conn.execute('INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?)',
+                          (tile, self._datestr(date), sensor, asset, filename))
+
+    def _insert_product(self, tile, date, sensor, product, filename):
+        self.conn.execute('INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?)',
+                          (tile, self._datestr(date), sensor, product, filename))
+
+    def _delete(self, tile, date):
+        args = (tile, self._datestr(date))
+        self.conn.execute('DELETE FROM assets WHERE tile=? AND date=?', args)
+        self.conn.execute('DELETE FROM products WHERE tile=? AND date=?', args)
+        self.conn.execute('DELETE FROM dirs WHERE tile=? AND date=?', args)
+
+    def _delete_tile(self, tile):
+        for table in ['assets', 'products', 'dirs']:
+            self.conn.execute('DELETE FROM %s WHERE tile=?' % table, (tile,))
+
+    def add_asset(self, tile, date, sensor, asset, filename):
+        """ Add asset file to catalog """
+        self._insert_asset(tile, date, sensor, asset, filename)
+        self.conn.commit()
+
+    def add_product(self, tile, date, sensor, product, filename):
+        """ Add product file to catalog """
+        self.add_products(tile, date, [(sensor, product, filename)])
+
+    def add_products(self, tile, date, products):
+        """ Add list of (sensor, product, filename) for this tile and date to catalog in a single commit """
+        for sensor, product, filename in products:
+            self._insert_product(tile, date, sensor, product, filename)
+        self.conn.commit()
+
+    def remove(self, tile, date):
+        """ Remove all assets and products for this tile and date """
+        self._delete(tile, date)
+        self.conn.commit()
+
+    def _add_data(self, dat):
+        """ Add assets and products found in a Data instance (does not commit) """
+        builtin = set()
+        for a in dat.assets.values():
+            self._insert_asset(dat.id, dat.date, a.sensor, a.asset, a.filename)
+            builtin.update([(a.sensor, p) for p in a.products])
+        # products that come automatically with assets are not stored
+        for (sensor, product), fname in dat.filenames.items():
+            if (sensor, product) not in builtin:
+                self._insert_product(dat.id, dat.date, sensor, product, fname)
+
+    def _recorded_dirs(self, tile):
+        """ Get recorded mtimes of tile level directories and of date directories for a tile """
+        tiledirs = {}
+        datedirs = {}
+        for path, date, mtime in self.conn.execute('SELECT path, date, mtime FROM dirs WHERE tile=?', (tile,)):
+            if date is None:
+                tiledirs[str(path)] = mtime
+            else:
+                datedirs[self._date(date)] = (str(path), mtime)
+        return (tiledirs, datedirs)
+
+    @staticmethod
+    def _mtime(path):
+        """ Modification time of path, None if it does not exist """
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def _refresh_tile(self, dataclass, tile):
+        """ Rescan date directories of tile that changed since recorded, return # rescanned """
+        repo = dataclass.Asset.Repository
+        tiledirs, datedirs = self._recorded_dirs(tile)
+        tiledirs.setdefault(repo.data_path(tile), None)
+        if all([self._mtime(d) == mtime for d, mtime in tiledirs.items()]):
+            # no date directories added or removed
+            dates = datedirs.keys()
+        else:
+            # record mtimes before scanning so changes made while scanning are caught next time
+            mtimes = {}
+            dates = repo.find_dates(tile)
+            for d in [repo.data_path(tile)] + [os.path.dirname(repo.data_path(tile, dt)) for dt in dates]:
+                mtimes[d] = self._mtime(d)
+            self.conn.execute('DELETE FROM dirs WHERE tile=? AND date IS NULL', (tile,))
+            for d, mtime in mtimes.items():
+                self.conn.execute('INSERT INTO dirs VALUES (?, ?, NULL, ?)', (d, tile, mtime))
+            for date in set(datedirs.keys()).difference(dates):
+                self._delete(tile, date)
+        numscanned = 0
+        for date in dates:
+            path = repo.data_path(tile, date)
+            mtime = self._mtime(path)
+            if mtime is None:
+                self._delete(tile, date)
+            elif date not in datedirs or datedirs[date][1] != mtime:
+                self._delete(tile, date)
+                try:
+                    self._add_data(dataclass(tile, date))
+                except Exception, e:
+                    # recorded without mtime so directory is rescanned next refresh
+                    VerboseOut(traceback.format_exc(), 4)
+                    VerboseOut('Unable to catalog %s: %s' % (path, e))
+                    self.conn.execute('INSERT INTO dirs VALUES (?, ?, ?, NULL)', (path, tile, self._datestr(date)))
+                    continue
+                self.conn.execute('INSERT INTO dirs VALUES (?, ?, ?, ?)', (path, tile, self._datestr(date), mtime))
+                numscanned = numscanned + 1
+        return numscanned
+
+    def _refresh(self, dataclass):
+        """ Rescan all changed directories in repository, return # of date directories rescanned """
+        repo = dataclass.Asset.Repository
+        tiles = repo.find_tiles()
+        numscanned = 0
+        Catalog.scanning = True
+        try:
+            for tile in tiles:
+                numscanned = numscanned + self._refresh_tile(dataclass, tile)
+                self.conn.commit()
+            # tiles that have been removed
+            for row in self.conn.execute('SELECT DISTINCT tile FROM dirs').fetchall():
+                if row[0] not in tiles:
+                    self._delete_tile(row[0])
+            self.conn.commit()
+        finally:
+            Catalog.scanning = False
+        return numscanned
+
+    @classmethod
+    def refresh(cls, dataclass):
+        """ Update catalog for all tile and date directories that have changed since last refresh """
+        start = datetime.now()
+        filename = dataclass.Asset.Repository.path(cls.filename)
+        if not os.path.exists(filename):
+            return cls.rebuild(dataclass)
+        catalog = cls.open(filename)
+        numscanned = catalog._refresh(dataclass)
+        VerboseOut('%s: refreshed %s directories in catalog in %s' %
+                   (dataclass.name, numscanned, datetime.now() - start))
+        return catalog
+
+    @classmethod
+    def rebuild(cls, dataclass):
+        """ Rebuild catalog for repository of this dataclass by scanning the repository """
+        start = datetime.now()
+        filename = dataclass.Asset.Repository.path(cls.filename)
+        # build new catalog alongside existing one, which is used until replaced
+        tmpname = filename + '.%s' % os.getpid()
+        catalog = cls(tmpname)
+        try:
+            catalog._refresh(dataclass)
+            counts = catalog.count()
+            catalog.conn.close()
+            cls.close(filename)
+            os.rename(tmpname, filename)
+        except:
+            catalog.conn.close()
+            os.remove(tmpname)
+            raise
+        VerboseOut('%s: cataloged %s assets and %s products in %s' %
+                   (dataclass.name, counts[0], counts[1], datetime.now() - start))
+        return cls.open(filename)
@@ -91,12 +91,14 @@ class SpatialExtent(object):
             for t in tiles:
                 extents.append(cls(dataclass, tiles=[t], pcov=pcov, ptile=ptile))
         else:
-            features = open_vector(site, key, where)
-            for f in features:
-                extents.append(cls(dataclass, feature=f, tiles=tiles, pcov=pcov, ptile=ptile))
+            features = [f for f in open_vector(site, key, where)]
+            # find tiles for all features at once
+            coverages = dataclass.Asset.Repository.vector2tiles_many(features, pcov, ptile, tiles)
+            for f, coverage in zip(features, coverages):
+                extents.append(cls(dataclass, feature=f, tiles=tiles, pcov=pcov, ptile=ptile, coverage=coverage))
         return extents
 
-    def __init__(self, dataclass, feature=None, tiles=None, pcov=0.0, ptile=0.0):
+    def __init__(self, dataclass, feature=None, tiles=None, pcov=0.0, ptile=0.0, coverage=None):
         """ Create spatial extent with a GeoFeature instance or list of tiles """
         self.repo = dataclass.Asset.Repository
 
@@ -108,7 +110,9 @@ class SpatialExtent(object):
             tiles = self.repo.find_tiles()
 
         if feature is not None:
-            tiles = self.repo.vector2tiles(feature, pcov, ptile, tiles)
+            if coverage is None:
+                coverage = self.repo.vector2tiles(feature, pcov, ptile, tiles)
+            tiles = coverage
             self.feature = (feature.Filename(), feature.LayerName(), feature.FID())
             self.sitename = feature.Basename()
         else:
@@ -124,6 +128,9 @@ class SpatialExtent(object):
     @property
     def available_dates(self):
         """ Get list of all dates for these tiles """
+        catalog = self.repo.catalog()
+        if catalog is not None:
+            return catalog.dates(self.tiles)
         dates = []
         for t in self.tiles:
             dates.extend(self.repo.find_dates(t))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+import os
+import json
+import shutil
+from datetime import datetime
+import numpy
+import gdal
+
+import gippy
+from gips.utils import VerboseOut, mkdir
+
+"""
+A cube is an on-disk copy of the time series of products in a project directory,
+so per-pixel algorithms run many times over a project do not reread every date file.
+Each product is stored in compressed blocks of pixels (one numpy .npz file per block),
+with the values of a pixel for all dates stored together. The dates, geotransform,
+projection and the stored data type, gain, offset and nodata value of each product
+are kept in a JSON metadata file, which is written last so a partial cube is never used.
+The modification time and size of each source file are also kept, so a cube is not
+used for files that have been changed since it was written.
+"""
+
+
+class Cube(object):
+    """ Chunked, compressed on-disk time series of the products in a project directory """
+    # metadata file in top level of cube directory
+    filename = 'cube.json'
+    # default cube directory within project directory
+    dirname = 'cube'
+    _datefmt = '%Y-%m-%d'
+
+    def __init__(self, path):
+        """ Open existing cube """
+        self.path = path
+        with open(os.path.join(path, self.filename)) as f:
+            self.meta = json.load(f)
+        self.dates = [datetime.strptime(d, self._datefmt).date() for d in self.meta['dates']]
+        self._dateindex = {d: i for i, d in enumerate(self.meta['dates'])}
+        self.shape = tuple(self.meta['shape'])
+        self.blocksize = tuple(self.meta['blocksize'])
+
+    @classmethod
+    def open(cls, path):
+        """ Open cube in path, None if there is no cube """
+        if os.path.exists(os.path.join(path, cls.filename)):
+            return cls(path)
+        return None
+
+    @classmethod
+    def create(cls, inventory, path, products=None, blocksize=(256, 256)):
+        """ Write time series of products (default all requested) in a ProjectInventory to a cube in path """
+        start = datetime.now()
+        if products is None:
+            products = inventory.requested_products
+        dates = inventory.dates
+        ds = gdal.Open(inventory.data[dates[0]][products[0]])
+        meta = {
+            'dates': [d.strftime(cls._datefmt) for d in dates],
+            'shape': [ds.RasterYSize, ds.RasterXSize],
+            'blocksize': [blocksize[0], blocksize[1]],
+            'geotransform': list(ds.GetGeoTransform()),
+            'projection': ds.GetProjection(),
+            'products': {},
+        }
+        ds = None
+        # replace any existing cube
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        mkdir(path)
+        rows, cols = meta['shape']
+        for p in products:
+            img = inventory.get_timeseries(p, dates=dates)
+            mkdir(os.path.join(path, p))
+            for y in range(0, rows, blocksize[1]):
+                for x in range(0, cols, blocksize[0]):
+                    width, height = min(blocksize[0], cols - x), min(blocksize[1], rows - y)
+                    ch = gippy.Recti(x, y, width, height)
+                    # time contiguous for each pixel
+                    block = numpy.dstack([img[i].ReadRaw(ch).reshape(height, width) for i in range(0, len(dates))])
+                    numpy.savez_compressed(cls._blockname(path, p, y // blocksize[1], x // blocksize[0]), data=block)
+            meta['products'][p] = {
+                'dtype': block.dtype.name,
+                'gain': img[0].Gain(),
+                'offset': img[0].Offset(),
+                'nodata': img[0].NoDataValue(),
+                'sources': {d.strftime(cls._datefmt): cls._stamp(inventory.data[d][p]) for d in dates},
+            }
+            img = None
+        tmpname = os.path.join(path, cls.filename + '.%s' % os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmpname, os.path.join(path, cls.filename))
+        VerboseOut('%s: cube of %s products and %s dates written in %s' %
+                   (path, len(products), len(dates), datetime.now() - start))
+        return cls(path)
+
+    @staticmethod
+    def _blockname(path, product, row, col):
+        return os.path.join(path, product, 'block_%s_%s.npz' % (row, col))
+
+    @staticmethod
+    def _stamp(filename):
+        """ [modification time, size] of a source file, None if it does not exist """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return [st.st_mtime, st.st_size]
+
+    def has(self, product, dates, filenames=None):
+        """ Check if cube holds product for all dates. If filenames (date: filename) given,
+        also check the files are unchanged since the cube was written """
+        if product not in self.meta['products'] or \
+                not all([d.strftime(self._datefmt) in self._dateindex for d in dates]):
+            return False
+        if filenames is None:
+            return True
+        sources = self.meta['products'][product].get('sources', {})
+        for d in dates:
+            stamp = sources.get(d.strftime(self._datefmt))
+            if stamp is None or stamp != self._stamp(filenames[d]):
+                VerboseOut('%s: %s has changed since cube was written' % (self.path, filenames[d]), 2)
+                return False
+        return True
+
+    def read(self, product, dates, chunk=None, raw=False):
+        """ Read (dates, rows, cols) array of product and the nodata value for chunk [x, y, width, height].
+        If raw the stored values are returned, otherwise gain and offset are applied """
+        pmeta = self.meta['products'][product]
+        inds = [self._dateindex[d.strftime(self._datefmt)] for d in dates]
+        if chunk is None:
+            chunk = [0, 0, self.shape[1], self.shape[0]]
+        x0, y0, width, height = chunk
+        bx, by = self.blocksize
+        data = numpy.empty((len(inds), height, width), dtype=pmeta['dtype'])
+        for by0 in range(y0 - y0 % by, y0 + height, by):
+            for bx0 in range(x0 - x0 % bx, x0 + width, bx):
+                block = numpy.load(self._blockname(self.path, product, by0 // by, bx0 // bx))['data']
+                ys = (max(y0, by0), min(y0 + height, by0 + block.shape[0]))
+                xs = (max(x0, bx0), min(x0 + width, bx0 + block.shape[1]))
+                data[:, ys[0] - y0:ys[1] - y0, xs[0] - x0:xs[1] - x0] = \
+                    block[ys[0] - by0:ys[1] - by0, xs[0] - bx0:xs[1] - bx0][:, :, inds].transpose(2, 0, 1)
+        nodata = pmeta['nodata']
+        if not raw and (pmeta['gain'] != 1.0 or pmeta['offset'] != 0.0):
+            # nodata pixels keep the nodata value
+            mask = data == nodata
+            data = data * pmeta['gain'] + pmeta['offset']
+            data[mask] = nodata
+        return (data, nodata)
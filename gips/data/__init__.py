@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+# Manifest of included data drivers (name: description) used to build command line
+# parsers without importing the drivers. Each driver's Repository.description is taken from here
+drivers = {
+    'aod': 'Aerosol Optical Depth from MODIS (MOD08)',
+    'cdl': 'Crop Data Layer',
+    'daymet': 'Daymet weather data',
+    'landsat': 'Landsat 5 (TM), 7 (ETM+), 8 (OLI)',
+    'merra': 'Modern Era Retrospective-Analysis for Research and Applications (weather and climate)',
+    'modis': 'MODIS Aqua and Terra',
+    'sar': 'Synthetic Aperture Radar PALSAR and JERS-1',
+    'sarannual': 'Synthetic Aperture Radar PALSAR Mosaics',
+}
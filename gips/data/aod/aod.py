@@ -27,16 +27,24 @@ import gdal
 import numpy
 import glob
 import traceback
+import multiprocessing
+from collections import OrderedDict
 
 import gippy
-from gips.data.core import Repository, Asset, Data
-from gips.utils import File2List, List2File, VerboseOut
+from gips.data import drivers
+from gips.data.core import Repository, Asset, Data, TileGrid
+from gips.utils import File2List, List2File, VerboseOut, chunks
 
 
 class aodRepository(Repository):
     name = 'AOD'
-    description = 'Aerosol Optical Depth from MODIS (MOD08)'
+    description = drivers['aod']
     _datedir = '%Y%j'
+    # single global tile
+    _grid = TileGrid(
+        'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],'
+        'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]',
+        origin=(-180.0, 90.0), size=(360.0, 180.0), shape=(1, 1), tileid='')
 
     @classmethod
     def data_path(cls, tile='', date=''):
@@ -61,11 +69,6 @@ class aodRepository(Repository):
                 dates.append(datetime.datetime.strptime(year + day, '%Y%j').date())
         return dates
 
-    @classmethod
-    def vector2tiles(cls, *args, **kwargs):
-        """ There are no tiles """
-        return {'': (1, 1)}
-
 
 class aodAsset(Asset):
     Repository = aodRepository
@@ -161,16 +164,31 @@ class aodData(Data):
 
     @classmethod
     def process_composites(cls, inventory, products, **kwargs):
+        # composites are reread by get_aod after being rebuilt
+        cls._ltad = None
+        cls._lta = None
         for product in products:
             cpath = os.path.join(cls.Asset.Repository.path('composites'), 'ltad')
             path = os.path.join(cpath, 'ltad')
             # Calculate AOT long-term multi-year averages (lta) for given day
             if product == 'ltad':
+                days = []
                 for day in range(inventory.start_day, inventory.end_day + 1):
                     dates = [d for d in inventory.dates if int(d.strftime('%j')) == day]
                     filenames = [inventory[d].tiles[''].products['aod'] for d in dates]
                     fout = path + '%s.tif' % str(day).zfill(3)
-                    cls.process_mean(filenames, fout)
+                    days.append((filenames, fout))
+                # days are independent
+                numprocs = getattr(inventory, 'numprocs', 1)
+                if numprocs > 1 and len(days) > 1:
+                    pool = multiprocessing.Pool(min(numprocs, len(days)))
+                    try:
+                        pool.map(_process_mean, days)
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    [_process_mean(day) for day in days]
             # Calculate single average per pixel (all days and years)
             if product == 'lta':
                 filenames = glob.glob(path + '*.tif')
@@ -182,127 +200,199 @@ class aodData(Data):
 
     @classmethod
     def process_mean(cls, filenames, fout):
-        """ Calculates mean of all filenames, and per pixel variances """
+        """ Calculates mean of all filenames, and per pixel variances, in a single pass over each window """
         start = datetime.datetime.now()
         if len(filenames) > 0:
-            img = gippy.GeoImage(filenames)
-            imgout = gippy.GeoImage(fout, img, gippy.GDT_Float32, 2)
+            imgs = [gippy.GeoImage(f) for f in filenames]
+            imgout = gippy.GeoImage(fout, imgs[0], gippy.GDT_Float32, 2)
             imgout.SetNoData(-32768)
-            img.Mean(imgout[0])
-            meanimg = imgout[0].Read()
-            for band in range(0, img.NumBands()):
-                data = img[band].Read()
-                mask = img[band].DataMask()
-                var = numpy.multiply(numpy.power(data - meanimg, 2), mask)
-                if band == 0:
-                    totalvar = var
-                    counts = mask
-                else:
-                    totalvar = totalvar + var
-                    counts = counts + mask
-            inds = numpy.where(counts == 0)
-            totalvar[inds] = -32768
-            inds = numpy.where(counts != 0)
-            totalvar[inds] = numpy.divide(totalvar[inds], counts[inds])
-            imgout[1].Write(totalvar)
+            for ch in chunks(imgs[0], numarrays=3):
+                # Welford's running mean and sum of squared deviations
+                for i, img in enumerate(imgs):
+                    data = img[0].Read(ch)
+                    mask = img[0].DataMask(ch) > 0
+                    if i == 0:
+                        counts = numpy.zeros(data.shape, dtype='float32')
+                        mean = numpy.zeros(data.shape, dtype='float64')
+                        m2 = numpy.zeros(data.shape, dtype='float64')
+                    counts[mask] = counts[mask] + 1
+                    delta = data[mask] - mean[mask]
+                    mean[mask] = mean[mask] + delta / counts[mask]
+                    m2[mask] = m2[mask] + delta * (data[mask] - mean[mask])
+                inds = numpy.where(counts == 0)
+                mean[inds] = -32768
+                m2[inds] = -32768
+                inds = numpy.where(counts != 0)
+                m2[inds] = numpy.divide(m2[inds], counts[inds])
+                imgout[0].Write(mean.astype('float32'), ch)
+                imgout[1].Write(m2.astype('float32'), ch)
             t = datetime.datetime.now() - start
             VerboseOut('%s: mean/var for %s files processed in %s' % (os.path.basename(fout), len(filenames), t))
         return imgout
 
-    @classmethod
-    def _read_point(cls, filename, roi, nodata):
-        """ Read single point from mean/var file and return if valid, or mean/var of 3x3 neighborhood """
-        if not os.path.exists(filename):
-            return (numpy.nan, numpy.nan)
-        try:
-            img = gippy.GeoImage(filename)
-            vals = img[0].Read(roi).squeeze()
-            variances = img[1].Read(roi)
-            vals[numpy.where(vals == nodata)] = numpy.nan
-            variances[numpy.where(variances == nodata)] = numpy.nan
-            val = numpy.nan
-            var = numpy.nan
-            if ~numpy.isnan(vals[1, 1]):
-                val = vals[1, 1]
-            elif numpy.any(~numpy.isnan(vals)):
-                val = numpy.mean(vals[~numpy.isnan(vals)])
-            if ~numpy.isnan(variances[1,1]):
-                var = variances[1, 1]
-            elif numpy.any(~numpy.isnan(variances)):
-                var = numpy.mean(variances[~numpy.isnan(variances)])
-            img = None
-            return (val, var)
-        except:
-            VerboseOut(traceback.format_exc(), 4)
-            return (numpy.nan, numpy.nan)
+    # cubes of daily AOD for the most recently used years, and of the LTA composites
+    _cubes = OrderedDict()
+    _maxyears = 2
+    _ltad = None
+    _lta = None
+    _nodata = -32768
 
     @classmethod
-    def get_aod(cls, lat, lon, date, fetch=True):
-        pixx = int(numpy.round(float(lon) + 179.5))
-        pixy = int(numpy.round(89.5 - float(lat)))
-        roi = gippy.Recti(pixx - 1, pixy - 1, 3, 3)
-        # try reading actual data file first
+    def _read_day(cls, year, index, fetch):
+        """ Read global AOD for a day of year (index from 0), fetching if needed """
+        date = datetime.date(year, 1, 1) + datetime.timedelta(days=index)
+        if date.year != year:
+            return None
         try:
-            # this is just for fetching the data
             inv = cls.inventory(dates=date.strftime('%Y-%j'), fetch=fetch, products=['aod'])
             img = inv[date].tiles[''].open('aod')
-            vals = img[0].Read(roi)
+            vals = img[0].Read()
             # TODO - do this automagically in swig wrapper
             vals[numpy.where(vals == img[0].NoDataValue())] = numpy.nan
-            aod = vals[1, 1]
             img = None
-            source = 'MODIS (MOD08_D3)'
-             # if invalid center but valid vals exist in 3x3
-            if numpy.isnan(aod) and numpy.any(~numpy.isnan(vals)):
-                aod = numpy.mean(vals[~numpy.isnan(vals)])
-                source = 'MODIS (MOD08_D3) spatial average'
+            return vals
         except Exception:
             VerboseOut(traceback.format_exc(), 4)
-            aod = numpy.nan
-
-        var = 0
-        totalvar = 0
-
-        day = date.strftime('%j')
-        # Calculate best estimate from multiple sources
-        repo = cls.Asset.Repository
-        cpath = repo.path('composites')
-        if numpy.isnan(aod):
-            aod = 0.0
-            norm = 0.0
-            cnt = 0
-            nodata = -32768
-
-            source = 'Weighted estimate using MODIS LTA values'
-            # LTA-Daily
-            filename = os.path.join(cpath, 'ltad', 'ltad%s.tif' % str(day).zfill(3))
-            val, var = cls._read_point(filename, roi, nodata)
-            var = var if var != 0.0 else val
-            if not numpy.isnan(val) and not numpy.isnan(var):
-                aod = val / var
-                totalvar = var
-                norm = 1.0 / var
-                cnt = cnt + 1
-                VerboseOut('AOD: LTA-Daily = %s, %s' % (val, var), 3)
-
-            # LTA
-            val, var = cls._read_point(os.path.join(cpath, 'lta.tif'), roi, nodata)
-            var = var if var != 0.0 else val
-            if not numpy.isnan(val) and not numpy.isnan(var):
-                aod = aod + val / var
-                totalvar = totalvar + var
-                norm = norm + 1.0 / var
-                cnt = cnt + 1
-                VerboseOut('AOD: LTA = %s, %s' % (val, var), 3)
-
-            # TODO - adjacent days
-
-            # Final AOD estimate
-            aod = aod / norm
-            totalvar = totalvar / cnt
-
-        if numpy.isnan(aod):
-            raise Exception("Could not retrieve AOD")
+            return None
+
+    @classmethod
+    def _read_composite(cls, filename):
+        """ Read mean and variance bands of a composite """
+        if not os.path.exists(filename):
+            return None
+        try:
+            img = gippy.GeoImage(filename)
+            vals = numpy.array([img[0].Read(), img[1].Read()])
+            vals[numpy.where(vals == cls._nodata)] = numpy.nan
+            img = None
+            return vals
+        except Exception:
+            VerboseOut(traceback.format_exc(), 4)
+            return None
+
+    @classmethod
+    def _daily(cls, year, fetch=True):
+        """ Cube of daily AOD for a year, keeping cubes of only the most recently used years """
+        if year in cls._cubes:
+            cube = cls._cubes.pop(year)
+        else:
+            cube = aodCube(366, 1, lambda index: cls._read_day(year, index, fetch))
+            while len(cls._cubes) >= cls._maxyears:
+                cls._cubes.popitem(last=False)
+        cls._cubes[year] = cube
+        return cube
+
+    @classmethod
+    def _composites(cls):
+        """ Cubes of the daily (ltad) and overall (lta) long term average mean and variance """
+        cpath = cls.Asset.Repository.path('composites')
+        if cls._ltad is None:
+            fname = os.path.join(cpath, 'ltad', 'ltad%s.tif')
+            cls._ltad = aodCube(366, 2, lambda index: cls._read_composite(fname % str(index + 1).zfill(3)))
+        if cls._lta is None:
+            cls._lta = aodCube(1, 2, lambda index: cls._read_composite(os.path.join(cpath, 'lta.tif')))
+        return (cls._ltad, cls._lta)
 
-        VerboseOut('AOD: Source = %s Value = %s' % (source, aod), 2)
+    @classmethod
+    def get_aods(cls, points, fetch=True):
+        """ Get (source, aod) for each (lat, lon, date) point, or (None, nan) if no AOD available """
+        points = list(points)
+        results = [None] * len(points)
+        days = {}
+        for i, (lat, lon, date) in enumerate(points):
+            days.setdefault(date, []).append(i)
+        for date, inds in days.items():
+            lats = numpy.array([points[i][0] for i in inds], dtype='float64')
+            lons = numpy.array([points[i][1] for i in inds], dtype='float64')
+            index = int(date.strftime('%j')) - 1
+            # try actual data first, or if invalid center use valid vals in 3x3
+            aods, averaged = _neighborhood(cls._daily(date.year, fetch).window(index, lats, lons)[:, 0])
+            # long term averages of the day and of all days, read only for points with no daily value
+            missing = numpy.where(numpy.isnan(aods))[0]
+            if len(missing) > 0:
+                ltad, lta = cls._composites()
+                mlats, mlons = lats[missing], lons[missing]
+                ltads = [_neighborhood(w)[0] for w in ltad.window(index, mlats, mlons).swapaxes(0, 1)]
+                ltas = [_neighborhood(w)[0] for w in lta.window(0, mlats, mlons).swapaxes(0, 1)]
+            for j, i in enumerate(inds):
+                aod = aods[j]
+                source = 'MODIS (MOD08_D3) spatial average' if averaged[j] else 'MODIS (MOD08_D3)'
+                if numpy.isnan(aod):
+                    # Calculate best estimate from multiple sources
+                    source = 'Weighted estimate using MODIS LTA values'
+                    aod = 0.0
+                    norm = 0.0
+                    k = numpy.searchsorted(missing, j)
+                    for name, (val, var) in [('LTA-Daily', ltads), ('LTA', ltas)]:
+                        val, var = val[k], var[k]
+                        var = var if var != 0.0 else val
+                        if not numpy.isnan(val) and not numpy.isnan(var):
+                            aod = aod + val / var
+                            norm = norm + 1.0 / var
+                            VerboseOut('AOD: %s = %s, %s' % (name, val, var), 3)
+                    # TODO - adjacent days
+                    # Final AOD estimate
+                    aod = aod / norm if norm != 0.0 else numpy.nan
+                if numpy.isnan(aod):
+                    results[i] = (None, numpy.nan)
+                else:
+                    VerboseOut('AOD: Source = %s Value = %s' % (source, aod), 2)
+                    results[i] = (source, aod)
+        return results
+
+    @classmethod
+    def get_aod(cls, lat, lon, date, fetch=True):
+        """ Get (source, aod) for a point and date """
+        source, aod = cls.get_aods([(lat, lon, date)], fetch=fetch)[0]
+        if source is None:
+            raise Exception("Could not retrieve AOD")
         return (source, aod)
+
+
+def _process_mean(args):
+    """ Mean and variance of (filenames, fout), used as pool worker """
+    aodData.process_mean(*args)
+
+
+def _neighborhood(vals):
+    """ Center values of 3x3 windows (n, 3, 3), or mean of valid values where center is invalid,
+    and whether the mean was used """
+    valid = ~numpy.isnan(vals)
+    counts = valid.sum(axis=2).sum(axis=1)
+    means = numpy.where(valid, vals, 0.0).sum(axis=2).sum(axis=1) / numpy.maximum(counts, 1)
+    means[counts == 0] = numpy.nan
+    center = vals[:, 1, 1]
+    averaged = numpy.isnan(center) & (counts > 0)
+    return (numpy.where(numpy.isnan(center), means, center), averaged)
+
+
+class aodCube(object):
+    """ Global 1 degree rasters for a series of days held as (day, band, lat, lon), each day read on first use """
+    shape = (180, 360)
+
+    def __init__(self, numdays, numbands, reader):
+        """ reader(index) returns (band, lat, lon) or (lat, lon) array for a day, or None if not available """
+        self.reader = reader
+        # pages are not allocated until a day is read
+        self.data = numpy.zeros((numdays, numbands) + self.shape, dtype='float32')
+        self.loaded = numpy.zeros(numdays, dtype='bool')
+
+    def day(self, index):
+        """ Get (band, lat, lon) array for day, reading it if not already read """
+        if not self.loaded[index]:
+            vals = self.reader(index)
+            self.data[index] = numpy.nan if vals is None else vals
+            self.loaded[index] = True
+        return self.data[index]
+
+    def window(self, index, lats, lons):
+        """ Get 3x3 windows (point, band, 3, 3) around each lat/lon, nan outside of grid """
+        data = self.day(index)
+        pixx = numpy.round(lons + 179.5).astype('int')
+        pixy = numpy.round(89.5 - lats).astype('int')
+        offsets = numpy.arange(-1, 2)
+        rows = pixy[:, None, None] + offsets[None, :, None]
+        cols = pixx[:, None, None] + offsets[None, None, :]
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        vals = data[:, rows.clip(0, self.shape[0] - 1), cols.clip(0, self.shape[1] - 1)].swapaxes(0, 1)
+        return numpy.where(inside[:, None], vals, numpy.nan)
@@ -25,12 +25,13 @@ import os
 from datetime import datetime
 from csv import DictReader
 
+from gips.data import drivers
 from gips.data.core import Repository, Asset, Data
 
 
 class cdlRepository(Repository):
     name = 'CDL'
-    description = 'Crop Data Layer'
+    description = drivers['cdl']
     _datedir = '%Y'
     _defaultresolution = [30.0, 30.0]
 
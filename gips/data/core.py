@@ -24,20 +24,27 @@
 import os
 import sys
 import errno
+import math
 from osgeo import gdal, ogr
 from datetime import datetime
 import glob
 from itertools import groupby
 from shapely.wkt import loads
+from shapely.geometry import box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 import tarfile
 import traceback
 import ftplib
 import shutil
 import commands
+import multiprocessing
 
 import gippy
 from gips import __version__
-from gips.utils import settings, VerboseOut, RemoveFiles, File2List, List2File, Colors, basename, mkdir, open_vector
+from gips.utils import settings, VerboseOut, RemoveFiles, File2List, List2File, Colors, basename, mkdir, open_vector, \
+    warp, warp_bounds, gdal_utilities
+from gips.catalog import Catalog
 from gippy.algorithms import CookieCutter
 
 """
@@ -46,6 +53,107 @@ For a new dataset create children of Repository, Asset, and Data
 """
 
 
+class TileFootprints(object):
+    """ Footprints of all tiles in a tiles vector with a spatial index (for irregular grids) """
+
+    def __init__(self, repository):
+        """ Read all tile footprints from tiles vector of repository """
+        v = open_vector(repository.get_setting('tiles'))
+        shp = ogr.Open(v.Filename())
+        if v.LayerName() == '':
+            layer = shp.GetLayer(0)
+        else:
+            layer = shp.GetLayer(v.LayerName())
+        self.srs = layer.GetSpatialRef().ExportToWkt()
+        self.tiles = []
+        self.geoms = []
+        layer.ResetReading()
+        feat = layer.GetNextFeature()
+        while feat is not None:
+            self.tiles.append(repository.feature2tile(feat))
+            self.geoms.append(loads(feat.GetGeometryRef().ExportToWkt()))
+            feat = layer.GetNextFeature()
+        self.prepared = [prep(g) for g in self.geoms]
+        self.tree = STRtree(self.geoms)
+        self._index = {id(g): i for i, g in enumerate(self.geoms)}
+
+    def coverage(self, geom):
+        """ Get dict of tile: (fraction of geom covered, fraction of tile used) for geom (in srs) """
+        tiles = {}
+        for g in self.tree.query(geom):
+            # index is returned by newer versions of shapely, geometry by older
+            i = self._index[id(g)] if hasattr(g, 'geom_type') else int(g)
+            if self.prepared[i].intersects(geom):
+                tgeom = self.geoms[i]
+                area = geom.intersection(tgeom).area
+                if area != 0:
+                    tiles[self.tiles[i]] = (area / geom.area, area / tgeom.area)
+        return tiles
+
+
+class TileGrid(object):
+    """ Regular grid of tiles, where tiles are found arithmetically rather than from a tiles vector """
+
+    def __init__(self, srs, origin, size, shape, tileid='h{h:02d}v{v:02d}', start=0):
+        """ Define grid
+        :srs: WKT of grid projection
+        :origin: (x, y) upper left corner of grid
+        :size: (width, height) of a single tile
+        :shape: (# tiles in x, # tiles in y)
+        :tileid: format of tile id, given horizontal (h) and vertical (v) tile index
+        :start: index of first tile (i.e., 0 or 1)
+        """
+        self.srs = srs
+        self.origin = origin
+        self.size = size
+        self.shape = shape
+        self.tileid = tileid
+        self.start = start
+        self._tiles = None
+
+    def tile(self, h, v):
+        """ Tile id of tile h, v (indexed from 0) """
+        return self.tileid.format(h=h + self.start, v=v + self.start)
+
+    def tile_bounds(self, h, v):
+        """ Bounds (xmin, ymin, xmax, ymax) of tile h, v (indexed from 0) """
+        x0 = self.origin[0] + h * self.size[0]
+        y1 = self.origin[1] - v * self.size[1]
+        return (x0, y1 - self.size[1], x0 + self.size[0], y1)
+
+    def bounds(self, tile):
+        """ Bounds (xmin, ymin, xmax, ymax) of tile id """
+        if self._tiles is None:
+            self._tiles = {self.tile(h, v): (h, v) for h in range(self.shape[0]) for v in range(self.shape[1])}
+        return self.tile_bounds(*self._tiles[tile])
+
+    def coverage(self, geom):
+        """ Get dict of tile: (fraction of geom covered, fraction of tile used) for geom (in srs),
+        a grid of a single (global) tile is always used in full so coverage thresholds never remove it """
+        if self.shape[0] * self.shape[1] == 1:
+            return {self.tile(0, 0): (1, 1)}
+        bounds = geom.bounds
+        h0 = max(int(math.floor((bounds[0] - self.origin[0]) / self.size[0])), 0)
+        h1 = min(int(math.floor((bounds[2] - self.origin[0]) / self.size[0])), self.shape[0] - 1)
+        v0 = max(int(math.floor((self.origin[1] - bounds[3]) / self.size[1])), 0)
+        v1 = min(int(math.floor((self.origin[1] - bounds[1]) / self.size[1])), self.shape[1] - 1)
+        garea = geom.area
+        tarea = self.size[0] * self.size[1]
+        tiles = {}
+        for h in range(h0, h1 + 1):
+            for v in range(v0, v1 + 1):
+                tbounds = self.tile_bounds(h, v)
+                if (tbounds[0] <= bounds[0] and tbounds[1] <= bounds[1] and
+                        bounds[2] <= tbounds[2] and bounds[3] <= tbounds[3]):
+                    # geometry entirely within tile
+                    area = garea
+                else:
+                    area = geom.intersection(box(*tbounds)).area
+                if area != 0:
+                    tiles[self.tile(h, v)] = (area / garea, area / tarea)
+        return tiles
+
+
 class Repository(object):
     """ Singleton (all classmethods) of file locations and sensor tiling system  """
     # Description of the data source
@@ -56,6 +164,10 @@ class Repository(object):
     _tile_attribute = 'tile'
     # valid sub directories in repo
     _subdirs = ['tiles', 'stage', 'quarantine', 'composites']
+    # regular tiling grid (TileGrid) used to find tiles rather than the tiles vector
+    _grid = None
+    # tile footprints keyed by (repository, tiles vector), shared by all repositories
+    _footprints = {}
 
     @classmethod
     def feature2tile(cls, feature):
@@ -116,52 +228,66 @@ class Repository(object):
         """ Paths to repository: valid subdirs (tiles, composites, quarantine, stage) """
         return os.path.join(cls.get_setting('repository'), subdir)
 
+    @classmethod
+    def catalog(cls):
+        """ Catalog of assets and products in repository (None if catalog not built) """
+        filename = cls.path(Catalog.filename)
+        if os.path.exists(filename) and not Catalog.scanning:
+            return Catalog.open(filename)
+        return None
 
     @classmethod
-    def vector2tiles(cls, vector, pcov=0.0, ptile=0.0, tilelist=None):
-        """ Return matching tiles and coverage % for provided vector """
-        from osgeo import ogr, osr
+    def refresh_catalog(cls):
+        """ Update catalog with tile and date directories changed since last refresh (builds if needed) """
+        from gips.utils import import_data_class
+        return Catalog.refresh(import_data_class(cls.__name__[:-10]))
 
-        # open tiles vector
-        v = open_vector(cls.get_setting('tiles'))
-        shp = ogr.Open(v.Filename())
-        if v.LayerName() == '':
-            layer = shp.GetLayer(0)
-        else:
-            layer = shp.GetLayer(v.LayerName())
 
-        # create and warp site geometry
-        ogrgeom = ogr.CreateGeometryFromWkt(vector.WKT())
-        srs = osr.SpatialReference(vector.Projection())
-        trans = osr.CoordinateTransformation(srs, layer.GetSpatialRef())
-        ogrgeom.Transform(trans)
-        # convert to shapely
-        geom = loads(ogrgeom.ExportToWkt())
+    @classmethod
+    def vector2tiles(cls, vector, pcov=0.0, ptile=0.0, tilelist=None):
+        """ Return matching tiles and coverage % for provided vector """
+        return cls.vector2tiles_many([vector], pcov, ptile, tilelist)[0]
 
-        # find overlapping tiles
-        tiles = {}
-        layer.SetSpatialFilter(ogrgeom)
-        layer.ResetReading()
-        feat = layer.GetNextFeature()
-        while feat is not None:
-            tgeom = loads(feat.GetGeometryRef().ExportToWkt())
-            if tgeom.overlaps(geom):
-                area = geom.intersection(tgeom).area
-                if area != 0:
-                    tile = cls.feature2tile(feat)
-                    tiles[tile] = (area / geom.area, area / tgeom.area)
-            feat = layer.GetNextFeature()
+    @classmethod
+    def tile_index(cls):
+        """ Index used to find tiles: regular grid if declared (and no tiles vector set), else tiles vector """
+        if cls._grid is not None and 'tiles' not in settings().REPOS[cls.__name__[:-10]]:
+            return cls._grid
+        key = (cls.__name__, cls.get_setting('tiles'))
+        if key not in Repository._footprints:
+            Repository._footprints[key] = TileFootprints(cls)
+        return Repository._footprints[key]
 
-        # remove any tiles not in tilelist or that do not meet thresholds for % cover
-        remove_tiles = []
-        if tilelist is None:
-            tilelist = tiles.keys()
-        for t in tiles:
-            if (tiles[t][0] < (pcov / 100.0)) or (tiles[t][1] < (ptile / 100.0)) or t not in tilelist:
-                remove_tiles.append(t)
-        for t in remove_tiles:
-            tiles.pop(t, None)
-        return tiles
+    @classmethod
+    def vector2tiles_many(cls, features, pcov=0.0, ptile=0.0, tilelist=None):
+        """ Return matching tiles and coverage % (as in vector2tiles) for each feature """
+        from osgeo import osr
+        index = cls.tile_index()
+        tsrs = osr.SpatialReference(index.srs)
+        transforms = {}
+        coverages = []
+        for feature in features:
+            # warp site geometry to tiles projection and convert to shapely
+            proj = feature.Projection()
+            if proj not in transforms:
+                transforms[proj] = osr.CoordinateTransformation(osr.SpatialReference(proj), tsrs)
+            ogrgeom = ogr.CreateGeometryFromWkt(feature.WKT())
+            ogrgeom.Transform(transforms[proj])
+            geom = loads(ogrgeom.ExportToWkt())
+            ogrgeom = None
+
+            tiles = index.coverage(geom)
+
+            # remove any tiles not in tilelist or that do not meet thresholds for % cover
+            remove_tiles = []
+            for t in tiles:
+                if ((tiles[t][0] < (pcov / 100.0)) or (tiles[t][1] < (ptile / 100.0)) or
+                        (tilelist is not None and t not in tilelist)):
+                    remove_tiles.append(t)
+            for t in remove_tiles:
+                tiles.pop(t, None)
+            coverages.append(tiles)
+        return coverages
 
 
 class Asset(object):
@@ -269,9 +395,15 @@ class Asset(object):
             assets = [asset]
         else:
             assets = cls._assets.keys()
+        catalog = cls.Repository.catalog()
+        if catalog is not None:
+            cataloged = catalog.assets(tile, date, asset)
         found = []
         for a in assets:
-            files = glob.glob(os.path.join(tpath, cls._assets[a]['pattern']))
+            if catalog is None:
+                files = glob.glob(os.path.join(tpath, cls._assets[a]['pattern']))
+            else:
+                files = [f for code, f in cataloged if code == a]
             # more than 1 asset??
             if len(files) > 1:
                 VerboseOut(files, 2)
@@ -403,6 +535,7 @@ class Asset(object):
             dates = [dates]
         numlinks = 0
         otherversions = False
+        catalog = cls.Repository.catalog()
         for d in dates:
             tpath = cls.Repository.data_path(asset.tile, d)
             newfilename = os.path.join(tpath, bname)
@@ -432,10 +565,14 @@ class Asset(object):
                     except OSError as exc:
                         VerboseOut('Unable to remove all products from {}'
                                    .format(tpath))
+                    if catalog is not None:
+                        catalog.remove(asset.tile, d)
                     try:
                         os.link(os.path.abspath(filename), newfilename)
                         VerboseOut(bname + ' -> ' + newfilename, 2)
                         numlinks = numlinks + 1
+                        if catalog is not None:
+                            catalog.add_asset(asset.tile, d, asset.sensor, asset.asset, newfilename)
                     except Exception, e:
                         VerboseOut(traceback.format_exc(), 3)
                         raise Exception('Problem adding {} to archive: {}'
@@ -453,6 +590,8 @@ class Asset(object):
                         #shutil.move(os.path.abspath(f),newfilename)
                         VerboseOut(bname + ' -> ' + newfilename, 2)
                         numlinks = numlinks + 1
+                        if catalog is not None:
+                            catalog.add_asset(asset.tile, d, asset.sensor, asset.asset, newfilename)
                     except Exception, e:
                         VerboseOut(traceback.format_exc(), 3)
                         raise Exception('Problem adding %s to archive: %s' % (filename, e))
@@ -465,6 +604,91 @@ class Asset(object):
         # should return asset instance
 
 
+class Intermediates(object):
+    """ Intermediate results shared by products, each built once and freed when no product needs it """
+
+    def __init__(self, graph, build, required, release=None):
+        """ Plan intermediates for products
+        :graph: dict of intermediate name: list of intermediates it is made from
+        :build: function(name, inputs) that creates intermediate from dict of its inputs
+        :required: dict of product: list of intermediates the product is made from
+        :release: function(name, item) called when intermediate is freed
+        """
+        self.graph = graph
+        self.build = build
+        self.release = release
+        self.items = {}
+        # closure of intermediates for each pending product, and # of pending products using each intermediate
+        self.pending = {}
+        self.refs = {}
+        for product, names in required.items():
+            self.pending[product] = self._closure(names)
+            for name in self.pending[product]:
+                self.refs[name] = self.refs.get(name, 0) + 1
+
+    def _closure(self, names):
+        """ All intermediates needed to create these intermediates """
+        closure = set()
+        names = list(names)
+        while len(names) > 0:
+            name = names.pop()
+            if name not in closure:
+                closure.add(name)
+                names.extend(self.graph[name])
+        return closure
+
+    def __contains__(self, name):
+        """ Intermediate is needed by a pending product """
+        return name in self.refs
+
+    def __getitem__(self, name):
+        """ Get intermediate, building it (and its inputs) if not already built """
+        if name not in self.items:
+            inputs = {n: self[n] for n in self.graph[name]}
+            self.items[name] = self.build(name, inputs)
+        return self.items[name]
+
+    def done(self, product):
+        """ Product is complete, free intermediates no pending product needs """
+        for name in self.pending.pop(product, []):
+            self.refs[name] = self.refs[name] - 1
+            if self.refs[name] == 0:
+                del self.refs[name]
+                self._free(name)
+
+    def clear(self):
+        """ Free all intermediates """
+        self.pending = {}
+        self.refs = {}
+        for name in self.items.keys():
+            self._free(name)
+
+    def _free(self, name):
+        item = self.items.pop(name, None)
+        if item is not None and self.release is not None:
+            self.release(name, item)
+
+
+def _copy_product(job):
+    """ Copy, or warp to srs if given, a single product (used as pool worker), return (fout, error) """
+    fin, fout, srs, res, interpolation, bounds, numthreads, vrt = job
+    try:
+        if srs is not None:
+            # warp just this tile
+            warp(fin, fout, srs, res, interpolation, bounds, numthreads, format='VRT' if vrt else 'GTiff')
+        elif vrt:
+            gdal_utilities().Translate(fout, fin, format='VRT')
+        else:
+            gippy.GeoImage(fin).Process(fout)
+            #shutil.copyfile(fin, fout)
+        return (fout, None)
+    except Exception, e:
+        VerboseOut(traceback.format_exc(), 4)
+        # remove partial output
+        RemoveFiles([fout], ['.aux.xml'])
+        return (fout, str(e))
+
+
 class Data(object):
     """ Collection of assets/products for single date and spatial region """
     name = 'Data'
@@ -492,8 +716,11 @@ class Data(object):
         """ Process composite products using provided inventory """
         pass
 
-    def copy(self, dout, products, site=None, res=None, interpolation=0, crop=False, overwrite=False, tree=False):
-        """ Copy products to new directory, warp to projection if given site """
+    def copy(self, dout, products, site=None, res=None, interpolation=0, crop=False, overwrite=False, tree=False,
+             vrt=False, numprocs=2):
+        """ Copy products to new directory, warp to projection if given site (cropped to the
+        bounding box of the site if crop). If vrt create VRT files referencing the products instead of
+        copying data. Products are copied or warped at once in up to numprocs processes """
         # TODO - allow hard and soft linking options
         if res is None:
             res = self.Asset._defaultresolution
@@ -504,30 +731,52 @@ class Data(object):
         mkdir(dout)
         products = self.RequestedProducts(products)
         bname = '%s_%s' % (self.id, self.date.strftime('%Y%j'))
+        jobs = []
         for p in products.requested:
             if p not in self.sensors:
                 # this product is not available for this day
                 continue
             sensor = self.sensors[p]
-            fin = self.filenames[(sensor, p)]
-            fout = os.path.join(dout, "%s_%s_%s.tif" % (bname, sensor, p))
+            fin = os.path.abspath(self.filenames[(sensor, p)])
+            fout = os.path.join(dout, "%s_%s_%s.%s" % (bname, sensor, p, 'vrt' if vrt else 'tif'))
             if not os.path.exists(fout) or overwrite:
-                try:
-                    if site is not None:
-                        # warp just this tile
-                        resampler = ['near', 'bilinear', 'cubic']
-                        cmd = 'gdalwarp %s %s -t_srs "%s" -tr %s %s -r %s' % \
-                               (fin, fout, site.Projection(), res[0], res[1], resampler[interpolation])
-                        print cmd
-                        #result = commands.getstatusoutput(cmd)
-                    else:
-                        gippy.GeoImage(fin).Process(fout)
-                        #shutil.copyfile(fin, fout)
-                except Exception:
-                    VerboseOut(traceback.format_exc(), 4)
-                    VerboseOut("Problem creating %s" % fout)
+                jobs.append((fin, fout))
+        if len(jobs) == 0:
+            return
+        srs, bounds = None, None
+        if site is not None:
+            srs = site.Projection()
+            # all products of a tile are on the same grid, so the warped output grid is found once
+            # (each warp still creates its own GDAL transformer, which cannot be passed to gdal.Warp)
+            bounds = warp_bounds(jobs[0][0], srs, res)
+            if crop:
+                # only the part of the tile within the bounding box of the site
+                env = ogr.CreateGeometryFromWkt(site.WKT()).GetEnvelope()
+                bounds = (max(bounds[0], math.floor(env[0] / res[0]) * res[0]),
+                          max(bounds[1], math.floor(env[2] / res[1]) * res[1]),
+                          min(bounds[2], math.ceil(env[1] / res[0]) * res[0]),
+                          min(bounds[3], math.ceil(env[3] / res[1]) * res[1]))
+                if bounds[0] >= bounds[2] or bounds[1] >= bounds[3]:
+                    VerboseOut('%s tile %s: does not overlap site' % (self.date, self.id))
+                    return
+        # threads of each warp share numprocs with the processes
+        nproc = min(numprocs, len(jobs))
+        numthreads = max(1, numprocs / nproc)
+        jobs = [(fin, fout, srs, res, interpolation, bounds, numthreads, vrt) for fin, fout in jobs]
+        if nproc > 1:
+            # gdal.Warp holds the GIL, so each product is copied in its own process
+            pool = multiprocessing.Pool(nproc)
+            results = pool.map(_copy_product, jobs)
+            pool.close()
+            pool.join()
+        else:
+            results = [_copy_product(job) for job in jobs]
+        failed = [(fout, error) for fout, error in results if error is not None]
         procstr = 'copied' if site is None else 'warped'
-        VerboseOut('%s tile %s: %s files %s' % (self.date, self.id, len(products.requested), procstr))
+        VerboseOut('%s tile %s: %s files %s, %s failed' % (self.date, self.id, len(jobs) - len(failed), procstr,
+                                                          len(failed)))
+        for fout, error in failed:
+            VerboseOut('  Problem creating %s: %s' % (fout, error))
 
     def filter(self, **kwargs):
         """ Check if tile passes filter - autofail if there are no assets or products """
@@ -560,6 +809,7 @@ class Data(object):
         self.assets = {}                # dict of asset name: Asset instance
         self.filenames = {}             # dict of (sensor, product): filename
         self.sensors = {}               # dict of asset/product: sensor
+        self._uncataloged = []          # list of (sensor, product, filename) not yet in catalog
         if tile is not None and date is not None:
             self.path = self.Repository.data_path(tile, date)
             self.basename = self.id + '_' + self.date.strftime(self.Repository._datedir)
@@ -628,6 +878,13 @@ class Data(object):
     def ParseAndAddFiles(self, filenames=None):
         """ Parse and Add filenames to existing filenames """
         if filenames is None:
+            catalog = self.Repository.catalog() if self.id is not None else None
+            if catalog is not None:
+                # cataloged products are already parsed
+                for sensor, product, f in catalog.products(self.id, self.date):
+                    self.filenames[(sensor, product)] = f
+                    self.sensors[product] = sensor
+                return
             filenames = self.find_files()
         datedir = self.Repository._datedir
         for f in filenames:
@@ -653,12 +910,24 @@ class Data(object):
                 # This was just a bad file
                 VerboseOut('Unrecognizable file: %s' % f, 3)
                 continue
+        self.catalog_products()
 
     def AddFile(self, sensor, product, filename):
         """ Add products (dictionary  (sensor, product): filename) to instance """
         self.filenames[(sensor, product)] = filename
         # TODO - currently assumes single sensor for each product
         self.sensors[product] = sensor
+        # products of repository tiles are recorded in catalog by catalog_products
+        if self.id is not None and self.date is not None:
+            self._uncataloged.append((sensor, product, filename))
+
+    def catalog_products(self):
+        """ Record products added since last called in catalog (if built), in a single commit """
+        if len(self._uncataloged) > 0:
+            catalog = self.Repository.catalog()
+            if catalog is not None:
+                catalog.add_products(self.id, self.date, self._uncataloged)
+            self._uncataloged = []
 
     def asset_filenames(self, product):
         assets = self._products[product]['assets']
@@ -728,7 +997,8 @@ class Data(object):
     @classmethod
     def discover(cls, path):
         """ Find products in path and return Data object for each date """
-        files0 = glob.glob(os.path.join(path, cls._pattern))
+        # project directories may hold VRT files (gips_project --vrt)
+        files0 = sorted(set(glob.glob(os.path.join(path, cls._pattern)) + glob.glob(os.path.join(path, '*.vrt'))))
         files = []
         datedir = cls.Asset.Repository._datedir
         for f in files0:
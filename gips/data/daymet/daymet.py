@@ -29,6 +29,7 @@ import numpy as np
 from pydap.client import open_url
 
 import gippy
+from gips.data import drivers
 from gips.data.core import Repository, Asset, Data
 from gips.utils import VerboseOut, basename
 
@@ -54,7 +55,7 @@ PROJ = """PROJCS["unnamed",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",63
 
 class daymetRepository(Repository):
     name = 'Daymet'
-    description = 'Daymet weather data'
+    description = drivers['daymet']
 
     # @classmethod
     # def tile_bounds(cls, tile):
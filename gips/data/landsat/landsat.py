@@ -25,24 +25,75 @@ import os
 import re
 from datetime import datetime
 import shutil
+import tempfile
 import numpy
 import glob
 import traceback
 from copy import deepcopy
 
 import gippy
-from gippy.algorithms import ACCA, Fmask, LinearTransform, Indices
-from gips.data.core import Repository, Asset, Data
-from gips.atmosphere import SIXS, MODTRAN
-from gips.utils import VerboseOut, RemoveFiles, basename, settings
+from gippy.algorithms import ACCA, Fmask, Indices
+from gips.data import drivers
+from gips.data.core import Repository, Asset, Data, Intermediates
+from gips.utils import VerboseOut, RemoveFiles, basename, settings, chunks
 
 requirements = ['Py6S>=1.5.0']
 
 
+def _tcap(reflimg, fname, coef, chunksize=None):
+    """ Tasseled cap transform of reflectance image, read, transformed and written in windows """
+    bands = ['BLUE', 'GREEN', 'RED', 'NIR', 'SWIR1', 'SWIR2']
+    coef = numpy.array(coef).astype('float32')
+    imgout = gippy.GeoImage(fname, reflimg, gippy.GDT_Float32, coef.shape[0])
+    outbands = ['Brightness', 'Greenness', 'Wetness', 'TCT4', 'TCT5', 'TCT6']
+    for i in range(0, imgout.NumBands()):
+        imgout.SetBandName(outbands[i], i + 1)
+    imgout.SetNoData(-32768)
+    # input bands, output band and mask of a window in memory at once
+    for ch in chunks(reflimg, numarrays=len(bands) + 2, chunksize=chunksize):
+        data = [reflimg[band].Read(ch).astype('float32') for band in bands]
+        nodatainds = numpy.zeros(data[0].shape, dtype='bool')
+        for band, arr in zip(bands, data):
+            nodatainds |= arr == reflimg[band].NoDataValue()
+        for i in range(0, imgout.NumBands()):
+            # same order of float32 operations for every window
+            out = data[0] * coef[i, 0]
+            for j in range(1, len(bands)):
+                out = out + data[j] * coef[i, j]
+            out[nodatainds] = imgout[i].NoDataValue()
+            imgout[i].Write(out, ch)
+    return imgout
+
+
+def _volref(reflimg, fname, bands, chunksize=None):
+    """ Volumetric water reflectance of bands of reflectance image, read, calculated and written in windows """
+    imgout = gippy.GeoImage(fname, reflimg, gippy.GDT_Int16, len(bands))
+    [imgout.SetBandName(band, i + 1) for i, band in enumerate(bands)]
+    imgout.SetNoData(-32768)
+    imgout.SetGain(0.0001)
+    r = 0.54    # Water-air reflection
+    p = 0.03    # Internal Fresnel reflectance
+    pp = 0.54   # Water-air Fresnel reflectance
+    n = 1.34    # Refractive index of water
+    Q = 1.0     # Downwelled irradiance / upwelled radiance
+    A = ((1 - p) * (1 - pp)) / (n * n)
+    for ch in chunks(reflimg, numarrays=4, chunksize=chunksize):
+        srband = reflimg['SWIR1'].Read(ch)
+        nodatainds = srband == reflimg['SWIR1'].NoDataValue()
+        for band in bands:
+            bimg = reflimg[band].Read(ch)
+            diffimg = bimg - srband
+            diffimg = diffimg / (A + r * Q * diffimg)
+            diffimg[bimg == reflimg[band].NoDataValue()] = imgout[band].NoDataValue()
+            diffimg[nodatainds] = imgout[band].NoDataValue()
+            imgout[band].Write(diffimg, ch)
+    return imgout
+
+
 class landsatRepository(Repository):
     """ Singleton (all class methods) to be overridden by child data classes """
     name = 'Landsat'
-    description = 'Landsat 5 (TM), 7 (ETM+), 8 (OLI)'
+    description = drivers['landsat']
     _tile_attribute = 'pr'
 
     @classmethod
@@ -179,23 +230,39 @@ class landsatData(Data):
         'Index': ['bi', 'evi', 'lswi', 'msavi2', 'ndsi', 'ndvi', 'ndwi', 'satvi'],
         'Tillage': ['ndti', 'crc', 'sti', 'isti'],
     }
+    # intermediate images (and the intermediates each is made from) that products require
+    # raw: radiance, atm: 6S model, toa: TOA reflectance and temperature, sref: surface reflectance
+    # toa products use toa in place of sref, and do not need atm
+    _intermediates = {
+        'raw': [],
+        'atm': [],
+        'toa': ['raw'],
+        'sref': ['raw', 'atm'],
+    }
+    # DN copied out of tar.gz file while processing (see _copydn)
+    _dncopy = False
+    _dnfile = None
     __toastring = 'toa: use top of the atmosphere reflectance'
     _products = {
         #'Standard':
         'rad': {
             'description': 'Surface-leaving radiance',
+            'requires': ['raw', 'atm'],
             'arguments': [__toastring]
         },
         'ref': {
             'description': 'Surface reflectance',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'temp': {
             'description': 'Brightness (apparent) temperature',
+            'requires': ['toa'],
             'toa': True
         },
         'acca': {
             'description': 'Automated Cloud Cover Assessment',
+            'requires': ['toa'],
             'arguments': [
                 'X: erosion kernel diameter in pixels (default: 5)',
                 'Y: dilation kernel diameter in pixels (default: 10)',
@@ -206,74 +273,91 @@ class landsatData(Data):
         },
         'fmask': {
             'description': 'Fmask cloud cover',
+            'requires': ['toa'],
             'nargs': '*',
             'toa': True
         },
         'tcap': {
             'description': 'Tassled cap transformation',
+            'requires': ['toa'],
             'toa': True
         },
         'dn': {
             'description': 'Raw digital numbers',
+            'requires': ['raw'],
             'toa': True
         },
         'volref': {
             'description': 'Volumetric water reflectance - valid for water only',
+            'requires': ['toa'],
             'arguments': [__toastring]
         },
         'wtemp': {
             'description': 'Water temperature (atmospherically correct) - valid for water only',
+            'requires': ['raw'],
             # It's not really TOA, but the product code will take care of atm correction itself
             'toa': True
         },
         #'Indices': {
         'bi': {
             'description': 'Brightness Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'evi': {
             'description': 'Enhanced Vegetation Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'lswi': {
             'description': 'Land Surface Water Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'msavi2': {
             'description': 'Modified Soil-Adjusted Vegetation Index (revised)',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'ndsi': {
             'description': 'Normalized Difference Snow Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'ndvi': {
             'description': 'Normalized Difference Vegetation Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'ndwi': {
             'description': 'Normalized Difference Water Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'satvi': {
             'description': 'Soil-Adjusted Total Vegetation Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         #'Tillage Indices': {
         'ndti': {
             'description': 'Normalized Difference Tillage Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'crc': {
             'description': 'Crop Residue Cover',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'sti': {
             'description': 'Standard Tillage Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
         'isti': {
             'description': 'Inverse Standard Tillage Index',
+            'requires': ['sref'],
             'arguments': [__toastring]
         },
     }
@@ -284,6 +368,68 @@ class landsatData(Data):
         if len(products) == 0:
             return
 
+        # intermediates are created once for all products that need them
+        required = {key: self._requires(val) for key, val in products.requested.items()}
+        inter = Intermediates(self._intermediates, self._intermediate, required, self._release)
+        # copy DN out of the tarball if more than one product will read it
+        self._dncopy = len(required) > 1 and not settings().REPOS[self.Repository.name]['extract']
+        try:
+            self._process(products, inter)
+        finally:
+            inter.clear()
+            # DN copy removed even if raw image was never built
+            self._removedn()
+
+    def _requires(self, val):
+        """ Intermediates required for product (e.g., ['ndvi', 'toa']) """
+        requires = self._products[val[0]].get('requires', [])
+        if self._products[val[0]].get('toa', False) or 'toa' in val:
+            requires = ['toa' if r == 'sref' else r for r in requires if r != 'atm']
+        return requires
+
+    def _intermediate(self, name, inputs):
+        """ Create intermediate image (or atmospheric model) from its inputs """
+        meta = self.assets[''].meta
+        visbands = self.assets[''].visbands
+        if name == 'raw':
+            if self._dncopy and self._dnfile is None:
+                self._copydn()
+            return self._readraw()
+        elif name == 'atm':
+            from gips.atmosphere import SIXS
+            wvlens = [(meta[b]['wvlen1'], meta[b]['wvlen2']) for b in visbands]
+            geo = self.metadata['geometry']
+            lut = None
+            if settings().REPOS[self.Repository.name].get('6Slut', False):
+                lut = self.sixs_lut(self.sensor_set[0])
+            return SIXS(visbands, wvlens, geo, self.metadata['datetime'], sensor=self.sensor_set[0],
+                        cachedir=self.Repository.path('6S'), lut=lut)
+        elif name == 'toa':
+            # non-atmospherically corrected apparent reflectance and temperature image
+            img = inputs['raw']
+            reflimg = gippy.GeoImage(img)
+            theta = numpy.pi * self.metadata['geometry']['solarzenith'] / 180.0
+            sundist = (1.0 - 0.016728 * numpy.cos(numpy.pi * 0.9856 * (float(self.day) - 4.0) / 180.0))
+            for col in visbands:
+                reflimg[col] = img[col] * (1.0 / ((meta[col]['E'] * numpy.cos(theta)) / (numpy.pi * sundist * sundist)))
+            for col in self.assets[''].lwbands:
+                reflimg[col] = (((img[col].pow(-1)) * meta[col]['K1'] + 1).log().pow(-1)) * meta[col]['K2'] - 273.15
+            return reflimg
+        elif name == 'sref':
+            img = inputs['raw']
+            atm6s = inputs['atm']
+            srefimg = gippy.GeoImage(img)
+            for col in visbands:
+                srefimg[col] = ((img[col] - atm6s.results[col][1]) / atm6s.results[col][0]) * (1.0 / atm6s.results[col][2])
+            return srefimg
+
+    def _release(self, name, item):
+        """ Remove DN copy when raw image is no longer needed """
+        if name == 'raw':
+            self._removedn()
+
+    def _process(self, products, inter):
+        """ Create products from intermediates """
         start = datetime.now()
 
         # Add the sensor for this date to the basename
@@ -291,7 +437,7 @@ class landsatData(Data):
 
         # Read the assets
         try:
-            img = self._readraw()
+            img = inter['raw']
         except Exception, e:
             VerboseOut(traceback.format_exc(), 5)
             raise Exception('Error reading %s: %s' % (basename(self.assets[''].filename), e))
@@ -302,17 +448,12 @@ class landsatData(Data):
         md = self.meta_dict()
 
         # running atmosphere if any products require it
-        toa = True
-        for val in products.requested.values():
-            toa = toa and (self._products[val[0]].get('toa', False) or 'toa' in val)
-        if not toa:
+        if 'atm' in inter:
             start = datetime.now()
             if not settings().REPOS[self.Repository.name]['6S']:
                 raise Exception('6S is required for atmospheric correction')
             try:
-                wvlens = [(meta[b]['wvlen1'], meta[b]['wvlen2']) for b in visbands]
-                geo = self.metadata['geometry']
-                atm6s = SIXS(visbands, wvlens, geo, self.metadata['datetime'], sensor=self.sensor_set[0])
+                atm6s = inter['atm']
                 md["AOD Source"] = str(atm6s.aod[0])
                 md["AOD Value"] = str(atm6s.aod[1])
             except Exception, e:
@@ -322,15 +463,6 @@ class landsatData(Data):
         # Break down by group
         groups = products.groups()
 
-        # create non-atmospherically corrected apparent reflectance and temperature image
-        reflimg = gippy.GeoImage(img)
-        theta = numpy.pi * self.metadata['geometry']['solarzenith'] / 180.0
-        sundist = (1.0 - 0.016728 * numpy.cos(numpy.pi * 0.9856 * (float(self.day) - 4.0) / 180.0))
-        for col in self.assets[''].visbands:
-            reflimg[col] = img[col] * (1.0 / ((meta[col]['E'] * numpy.cos(theta)) / (numpy.pi * sundist * sundist)))
-        for col in self.assets[''].lwbands:
-            reflimg[col] = (((img[col].pow(-1)) * meta[col]['K1'] + 1).log().pow(-1)) * meta[col]['K2'] - 273.15
-
         # This is landsat, so always just one sensor for a given date
         sensor = self.sensors['']
 
@@ -353,7 +485,7 @@ class landsatData(Data):
                         erosion = 5
                         dilation = 10
                         cloudheight = 4000
-                    imgout = ACCA(reflimg, fname, s_elev, s_azim, erosion, dilation, cloudheight)
+                    imgout = ACCA(inter['toa'], fname, s_elev, s_azim, erosion, dilation, cloudheight)
                 elif val[0] == 'fmask':
                     try:
                         tolerance = int(val[1]) if len(val) > 1 else 3
@@ -361,7 +493,7 @@ class landsatData(Data):
                     except:
                         tolerance = 3
                         dilation = 5
-                    imgout = Fmask(reflimg, fname, tolerance, dilation)
+                    imgout = Fmask(inter['toa'], fname, tolerance, dilation)
                 elif val[0] == 'rad':
                     imgout = gippy.GeoImage(fname, img, gippy.GDT_Int16, len(visbands))
                     for i in range(0, imgout.NumBands()):
@@ -382,29 +514,20 @@ class landsatData(Data):
                         imgout.SetBandName(visbands[i], i + 1)
                     imgout.SetNoData(-32768)
                     imgout.SetGain(0.0001)
-                    if toa:
-                        for c in visbands:
-                            reflimg[c].Process(imgout[c])
-                    else:
-                        for c in visbands:
-                            (((img[c] - atm6s.results[c][1]) / atm6s.results[c][0]) * (1.0 / atm6s.results[c][2])).Process(imgout[c])
+                    refimg = inter['toa'] if toa else inter['sref']
+                    for c in visbands:
+                        refimg[c].Process(imgout[c])
                     # Mask out any pixel for which any band is nodata
                     #imgout.ApplyMask(img.DataMask())
                 elif val[0] == 'tcap':
-                    tmpimg = gippy.GeoImage(reflimg)
-                    tmpimg.PruneBands(['BLUE', 'GREEN', 'RED', 'NIR', 'SWIR1', 'SWIR2'])
-                    arr = numpy.array(self.Asset._sensors[self.sensor_set[0]]['tcap']).astype('float32')
-                    imgout = LinearTransform(tmpimg, fname, arr)
-                    outbands = ['Brightness', 'Greenness', 'Wetness', 'TCT4', 'TCT5', 'TCT6']
-                    for i in range(0, imgout.NumBands()):
-                        imgout.SetBandName(outbands[i], i + 1)
+                    imgout = _tcap(inter['toa'], fname, self.Asset._sensors[self.sensor_set[0]]['tcap'])
                 elif val[0] == 'temp':
                     imgout = gippy.GeoImage(fname, img, gippy.GDT_Int16, len(lwbands))
                     for i in range(0, imgout.NumBands()):
                         imgout.SetBandName(lwbands[i], i + 1)
                     imgout.SetNoData(-32768)
                     imgout.SetGain(0.1)
-                    [reflimg[col].Process(imgout[col]) for col in lwbands]
+                    [inter['toa'][col].Process(imgout[col]) for col in lwbands]
                 elif val[0] == 'dn':
                     rawimg = self._readraw()
                     rawimg.SetGain(1.0)
@@ -414,38 +537,21 @@ class landsatData(Data):
                 elif val[0] == 'volref':
                     bands = deepcopy(visbands)
                     bands.remove("SWIR1")
-                    imgout = gippy.GeoImage(fname, reflimg, gippy.GDT_Int16, len(bands))
-                    [imgout.SetBandName(band, i + 1) for i, band in enumerate(bands)]
-                    imgout.SetNoData(-32768)
-                    imgout.SetGain(0.0001)
-                    r = 0.54    # Water-air reflection
-                    p = 0.03    # Internal Fresnel reflectance
-                    pp = 0.54   # Water-air Fresnel reflectance
-                    n = 1.34    # Refractive index of water
-                    Q = 1.0     # Downwelled irradiance / upwelled radiance
-                    A = ((1 - p) * (1 - pp)) / (n * n)
-                    srband = reflimg['SWIR1'].Read()
-                    nodatainds = srband == reflimg['SWIR1'].NoDataValue()
-                    for band in bands:
-                        bimg = reflimg[band].Read()
-                        diffimg = bimg - srband
-                        diffimg = diffimg / (A + r * Q * diffimg)
-                        diffimg[bimg == reflimg[band].NoDataValue()] = imgout[band].NoDataValue()
-                        diffimg[nodatainds] = imgout[band].NoDataValue()
-                        imgout[band].Write(diffimg)
+                    imgout = _volref(inter['toa'], fname, bands)
                 elif val[0] == 'wtemp':
                     imgout = gippy.GeoImage(fname, img, gippy.GDT_Int16, len(lwbands))
                     [imgout.SetBandName(lwbands[i], i + 1) for i in range(0, imgout.NumBands())]
                     imgout.SetNoData(-32768)
                     imgout.SetGain(0.1)
+                    from gips.atmosphere import MODTRAN
                     tmpimg = gippy.GeoImage(img)
-                    for col in lwbands:
-                        band = tmpimg[col]
-                        m = meta[col]
-                        lat = self.metadata['geometry']['lat']
-                        lon = self.metadata['geometry']['lon']
-                        dt = self.metadata['datetime']
-                        atmos = MODTRAN(m['bandnum'], m['wvlen1'], m['wvlen2'], dt, lat, lon, True)
+                    lat = self.metadata['geometry']['lat']
+                    lon = self.metadata['geometry']['lon']
+                    dt = self.metadata['datetime']
+                    # run all bands at once
+                    bands = [(meta[col]['bandnum'], meta[col]['wvlen1'], meta[col]['wvlen2']) for col in lwbands]
+                    atmoses = MODTRAN.run_bands(bands, dt, lat, lon, True)
+                    for col, atmos in zip(lwbands, atmoses):
                         e = 0.95
                         band = (tmpimg[col] - (atmos.output[1] + (1 - e) * atmos.output[2])) / (atmos.output[0] * e)
                         band = (((band.pow(-1)) * meta[col]['K1'] + 1).log().pow(-1)) * meta[col]['K2'] - 273.15
@@ -458,6 +564,7 @@ class landsatData(Data):
             except Exception, e:
                 VerboseOut('Error creating product %s for %s: %s' % (key, basename(self.assets[''].filename), e), 2)
                 VerboseOut(traceback.format_exc(), 3)
+            inter.done(key)
 
         # Process Indices
         indices0 = dict(groups['Index'], **groups['Tillage'])
@@ -473,17 +580,17 @@ class landsatData(Data):
             # Run TOA
             if len(indices_toa) > 0:
                 fnames = [os.path.join(self.path, self.basename + '_' + key) for key in indices_toa]
-                prodout = Indices(reflimg, dict(zip([p[0] for p in indices_toa.values()], fnames)), md)
+                prodout = Indices(inter['toa'], dict(zip([p[0] for p in indices_toa.values()], fnames)), md)
                 prodout = dict(zip(indices_toa.keys(), prodout.values()))
                 [self.AddFile(sensor, key, fname) for key, fname in prodout.items()]
+                [inter.done(key) for key in indices_toa]
             # Run atmospherically corrected
             if len(indices) > 0:
                 fnames = [os.path.join(self.path, self.basename + '_' + key) for key in indices]
-                for col in visbands:
-                    img[col] = ((img[col] - atm6s.results[col][1]) / atm6s.results[col][0]) * (1.0 / atm6s.results[col][2])
-                prodout = Indices(img, dict(zip([p[0] for p in indices.values()], fnames)), md)
+                prodout = Indices(inter['sref'], dict(zip([p[0] for p in indices.values()], fnames)), md)
                 prodout = dict(zip(indices.keys(), prodout.values()))
                 [self.AddFile(sensor, key, fname) for key, fname in prodout.items()]
+                [inter.done(key) for key in indices]
             VerboseOut(' -> %s: processed %s in %s' % (self.basename, indices0.keys(), datetime.now() - start), 1)
         img = None
 
@@ -596,26 +703,67 @@ class landsatData(Data):
         }
         #self.metadata.update(smeta)
 
+    @classmethod
+    def sixs_bands(cls, sensor):
+        """ Names and wavelengths (wvlen1, wvlen2) of bands corrected with 6S for sensor """
+        smeta = cls.Asset._sensors[sensor]
+        bands = []
+        wavelengths = []
+        for i, band in enumerate(smeta['colors']):
+            if band[0:4] != "LWIR":
+                wvlen = smeta['bandlocs'][i]
+                bands.append(band)
+                wavelengths.append((wvlen - smeta['bandwidths'][i] / 2.0, wvlen + smeta['bandwidths'][i] / 2.0))
+        return (bands, wavelengths)
+
+    @classmethod
+    def sixs_lut(cls, sensor):
+        """ Filename of 6S lookup table for sensor (see gips_atmlut) """
+        return os.path.join(cls.Asset.Repository.path('6S'), 'lut_%s.npz' % sensor)
+
     @classmethod
     def meta_dict(cls):
         meta = super(landsatData, cls).meta_dict()
         meta['GIPS-landsat Version'] = cls.version
         return meta
 
+    def _copydn(self):
+        """ Copy DN from tar.gz file to temporary file outside the repository, so it is decompressed only once """
+        start = datetime.now()
+        rawimg = self._readraw()
+        rawimg.SetGain(1.0)
+        rawimg.SetOffset(0.0)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self._dnfile = rawimg.Process(os.path.join(tmpdir, self.basename + '_dn')).Filename()
+        except:
+            shutil.rmtree(tmpdir)
+            raise
+        VerboseOut('%s: copied DN in %s' % (self.basename, datetime.now() - start), 3)
+
+    def _removedn(self):
+        """ Remove DN copy (see _copydn) if there is one """
+        if self._dnfile is not None:
+            shutil.rmtree(os.path.dirname(self._dnfile), ignore_errors=True)
+            self._dnfile = None
+
     def _readraw(self):
         """ Read in Landsat bands using original tar.gz file """
         start = datetime.now()
         # make sure metadata is loaded
         self.meta()
 
-        if settings().REPOS[self.Repository.name]['extract']:
-            # Extract all files
-            datafiles = self.assets[''].extract(self.metadata['filenames'])
+        if self._dnfile is not None:
+            # DN already copied out of tar.gz file
+            image = gippy.GeoImage(self._dnfile)
         else:
-            # Use tar.gz directly using GDAL's virtual filesystem
-            datafiles = [os.path.join('/vsitar/' + self.assets[''].filename, f) for f in self.metadata['filenames']]
-
-        image = gippy.GeoImage(datafiles)
+            if settings().REPOS[self.Repository.name]['extract']:
+                # Extract all files
+                datafiles = self.assets[''].extract(self.metadata['filenames'])
+            else:
+                # Use tar.gz directly using GDAL's virtual filesystem
+                datafiles = [os.path.join('/vsitar/' + self.assets[''].filename, f) for f in self.metadata['filenames']]
+            image = gippy.GeoImage(datafiles)
         image.SetNoData(0)
 
         # TODO - set appropriate metadata
@@ -28,8 +28,9 @@ from pydap.client import open_url
 import numpy
 
 import gippy
-from gips.data.core import Repository, Asset, Data
-from gips.utils import VerboseOut, basename, open_vector
+from gips.data import drivers
+from gips.data.core import Repository, Asset, Data, TileGrid
+from gips.utils import VerboseOut, basename
 
 from pdb import set_trace
 
@@ -39,15 +40,18 @@ requirements = ['pydap']
 
 class merraRepository(Repository):
     name = 'Merra'
-    description = 'Modern Era Retrospective-Analysis for Research and Applications (weather and climate)'
+    description = drivers['merra']
     _tile_attribute = 'tileid'
+    # global grid of 30 x 18 tiles (12 x 10 degrees), numbered from 1
+    _grid = TileGrid(
+        'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],'
+        'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]',
+        origin=(-180.0, 90.0), size=(12.0, 10.0), shape=(30, 18), start=1)
 
     @classmethod
     def tile_bounds(cls, tile):
         """ Get the bounds of the tile (in same units as tiles vector) """
-        vector = open_vector(cls.get_setting('tiles'))
-        extent = vector.where('tileid==%s' % tile).extent()
-        return [extent.x0(), extent.y0(), extent.x1(), extent.y1()]
+        return list(cls._grid.bounds(tile))
 
 
 class merraAsset(Asset):
@@ -32,7 +32,8 @@ import numpy as np
 
 import gippy
 from gippy.algorithms import Indices
-from gips.data.core import Repository, Asset, Data
+from gips.data import drivers
+from gips.data.core import Repository, Asset, Data, TileGrid
 from gips.utils import VerboseOut
 
 
@@ -45,7 +46,14 @@ def binmask(arr, bit):
 
 class modisRepository(Repository):
     name = 'Modis'
-    description = 'MODIS Aqua and Terra'
+    description = drivers['modis']
+    # MODIS sinusoidal grid of 36 x 18 tiles
+    _grid = TileGrid(
+        'PROJCS["Sinusoidal",GEOGCS["GCS_Unknown",DATUM["D_unknown",SPHEROID["Unknown",6371007.181,0]],'
+        'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]],PROJECTION["Sinusoidal"],'
+        'PARAMETER["central_meridian",0],PARAMETER["false_easting",0],PARAMETER["false_northing",0],'
+        'UNIT["Meter",1]]',
+        origin=(-20015109.354, 10007554.677), size=(1111950.5197665554, 1111950.5197665554), shape=(36, 18))
 
     @classmethod
     def feature2tile(cls, feature):
@@ -28,13 +28,14 @@ import copy
 import numpy
 
 import gippy
+from gips.data import drivers
 from gips.data.core import Repository, Asset, Data
 from gips.utils import File2List, List2File, RemoveFiles
 
 
 class sarRepository(Repository):
     name = 'SAR'
-    description = 'Synthetic Aperture Radar PALSAR and JERS-1'
+    description = drivers['sar']
 
     @classmethod
     def feature2tile(cls, feature):
@@ -25,13 +25,14 @@ import os
 import datetime
 
 import gippy
+from gips.data import drivers
 from gips.data.core import Repository, Asset, Data
 from gips.utils import RemoveFiles, VerboseOut
 
 
 class sarannualRepository(Repository):
     name = 'SARAnnual'
-    description = 'Synthetic Aperture Radar PALSAR Mosaics'
+    description = drivers['sarannual']
     _datedir = '%Y'
 
     @classmethod
@@ -26,13 +26,59 @@ import os
 from datetime import datetime as dt
 import traceback
 import numpy
+import multiprocessing
 from copy import deepcopy
+import gdal
 
 import gippy
 from gips.tiles import Tiles
 from gips.utils import VerboseOut, Colors
 from gips.data.core import Data
 from gips.mapreduce import MapReduce
+from gips.cube import Cube
+
+
+def _process_init(_tiledata, _procargs, _prockwargs, numcores=None):
+    """ Initializer sets globals for processes """
+    global tiledata, procargs, prockwargs
+    tiledata = _tiledata
+    procargs = _procargs
+    prockwargs = _prockwargs
+    if numcores is not None:
+        gippy.Options.SetNumCores(numcores)
+
+
+def _process_worker(unit):
+    """ Process a single (date, tile), return (unit, filenames, sensors, error) """
+    date, tile = unit
+    tiles = tiledata[date]
+    try:
+        tiles[tile].process(*procargs, products=tiles.products.products, **prockwargs)
+        error = None
+    except Exception, e:
+        VerboseOut(traceback.format_exc(), 4)
+        error = str(e)
+    if error is None:
+        # drivers may log a product error and carry on without creating it
+        missing = [p for p in sorted(tiles.products.standard) if p not in tiles[tile].products]
+        if len(missing) > 0:
+            error = 'products not created: %s' % ' '.join(missing)
+    tiles[tile].catalog_products()
+    # products created in the worker are returned to the inventory
+    return (unit, tiles[tile].filenames, tiles[tile].sensors, error)
+
+
+def _mosaic_worker(job):
+    """ Mosaic a single (date, product, datadir), return (job, filename, error) """
+    date, product, datadir = job
+    try:
+        fout = tiledata[date].mosaic_product(datadir, product, **prockwargs)
+        error = None
+    except Exception, e:
+        VerboseOut(traceback.format_exc(), 4)
+        fout = None
+        error = str(e)
+    return (job, fout, error)
 
 
 class Inventory(object):
@@ -117,10 +163,14 @@ class Inventory(object):
 
 class ProjectInventory(Inventory):
     """ Inventory of project directory (collection of Data class) """
+    # number of time series images opened in this process
+    opens = 0
 
     def __init__(self, projdir='', products=[]):
         """ Create inventory of a GIPS project directory """
         self.projdir = os.path.abspath(projdir)
+        # time series images kept open, keyed by (pid, product, dates)
+        self._images = {}
         if not os.path.exists(self.projdir):
             raise Exception('Directory %s does not exist!' % self.projdir)
 
@@ -141,6 +191,8 @@ class ProjectInventory(Inventory):
         except:
             VerboseOut(traceback.format_exc(), 4)
             raise Exception("%s does not appear to be a GIPS project directory" % self.projdir)
+        # time series read from cube when it holds them
+        self.cube = Cube.open(os.path.join(self.projdir, Cube.dirname))
 
     def products(self, date):
         """ Intersection of available products and requested products for this date """
@@ -161,28 +213,74 @@ class ProjectInventory(Inventory):
         sz = (len(self.requested_products), img.YSize(), img.XSize())
         return sz
 
-    def get_data(self, dates=None, products=None, chunk=None):
-        """ Read all files as time series, stacking all products """
-        # TODO - change to absolute dates
-        days = numpy.array([int(d.strftime('%j')) for d in dates])
-        imgarr = []
+    def to_cube(self, path=None, products=None, blocksize=(256, 256)):
+        """ Write time series of products to an on-disk cube (default in project directory, where
+        it is used by get_data and map_reduce) """
+        if path is None:
+            path = os.path.join(self.projdir, Cube.dirname)
+        cube = Cube.create(self, path, products=products, blocksize=blocksize)
+        if os.path.abspath(path) == os.path.join(self.projdir, Cube.dirname):
+            self.cube = cube
+        return cube
+
+    def _incube(self, product, dates):
+        """ Check if cube holds product for dates and the product files have not changed since """
+        return self.cube is not None and \
+            self.cube.has(product, dates, filenames={d: self.data[d][product] for d in dates})
+
+    def block_size(self):
+        """ Get native block size (x, y) of the files (or cube) in project """
+        if self.cube is not None:
+            return self.cube.blocksize
+        ds = gdal.Open(self.data[self.dates[0]][self.requested_products[0]])
+        blocksize = ds.GetRasterBand(1).GetBlockSize()
+        ds = None
+        return (blocksize[0], blocksize[1])
+
+    def get_data(self, dates=None, products=None, chunk=None, dtype='float64', nodata=numpy.nan, masked=False):
+        """ Read all files as time series, stacking all products into a (products * dates, rows, cols) array
+        of dtype. Integer dtypes hold the stored values (gain and offset not applied), avoiding float
+        copies of long Int16 stacks. Nodata pixels are set to nodata (None, or nan with an integer dtype,
+        keeps the stored nodata value), or masked in a numpy masked array if masked """
+        raw = not numpy.issubdtype(numpy.dtype(dtype), numpy.floating)
+        if raw and nodata is not None and numpy.isnan(nodata):
+            nodata = None
         if dates is None:
             dates = self.dates
         if products is None:
             products = self.requested_products
-        for p in products:
-            gimg = self.get_timeseries(p, dates=dates)
-            # TODO - move numpy.squeeze into swig interface file?
-            ch = gippy.Recti(chunk[0], chunk[1], chunk[2], chunk[3])
-            arr = numpy.squeeze(gimg.TimeSeries(days.astype('float64'), ch))
-            arr[arr == gimg[0].NoDataValue()] = numpy.nan
-            if len(days) == 1:
-                dims = arr.shape
-                arr = arr.reshape(1, dims[0], dims[1])
-            imgarr.append(arr)
-        data = numpy.vstack(tuple(imgarr))
+        if chunk is None:
+            sz = self.data_size()
+            chunk = [0, 0, sz[2], sz[1]]
+        data = numpy.empty((len(products) * len(dates), chunk[3], chunk[2]), dtype=dtype)
+        if masked:
+            mask = numpy.zeros(data.shape, dtype='bool')
+        for i, p in enumerate(products):
+            for j, (arr, nodatavalue) in enumerate(self._read(p, dates, chunk, raw)):
+                k = i * len(dates) + j
+                data[k] = arr
+                if masked:
+                    mask[k] = arr == nodatavalue
+                elif nodata is not None:
+                    data[k][arr == nodatavalue] = nodata
+        if masked:
+            return numpy.ma.array(data, mask=mask)
         return data
 
+    def _read(self, product, dates, chunk, raw=False):
+        """ Read chunk of product for each date, yielding (array, nodata value), from cube if it holds them """
+        if self._incube(product, dates):
+            data, nodatavalue = self.cube.read(product, dates, chunk, raw=raw)
+            for arr in data:
+                yield (arr, nodatavalue)
+        else:
+            gimg = self._timeseries(product, dates)
+            ch = gippy.Recti(chunk[0], chunk[1], chunk[2], chunk[3])
+            for j in range(0, len(dates)):
+                band = gimg[j]
+                arr = band.ReadRaw(ch) if raw else band.Read(ch)
+                yield (arr.reshape(chunk[3], chunk[2]), band.NoDataValue())
+
     def get_timeseries(self, product='', dates=None):
         """ Read all files as time series """
         if dates is None:
@@ -190,18 +288,62 @@ class ProjectInventory(Inventory):
         # TODO - multiple sensors
         filenames = [self.data[date][product] for date in dates]
         img = gippy.GeoImage(filenames)
+        ProjectInventory.opens = ProjectInventory.opens + 1
         return img
 
-    def map_reduce(self, func, numbands=1, products=None, readfunc=None, nchunks=100, **kwargs):
-        """ Apply func to inventory to generate an image with numdim output bands """
+    def open_timeseries(self, products=None, dates=None):
+        """ Open time series images of products and keep them for reuse by get_data in this process """
+        if dates is None:
+            dates = self.dates
+        if products is None:
+            products = self.requested_products
+        for p in products:
+            if not self._incube(p, dates):
+                self._images[(os.getpid(), p, tuple(dates))] = self.get_timeseries(p, dates=dates)
+
+    def _timeseries(self, product, dates):
+        """ Time series image kept open in this process by open_timeseries, or a newly opened one """
+        img = self._images.get((os.getpid(), product, tuple(dates)))
+        return img if img is not None else self.get_timeseries(product, dates=dates)
+
+    def map_reduce(self, func, numbands=1, products=None, readfunc=None, nchunks=None, memory=None,
+                   filename=None, window=None, cache=True, **kwargs):
+        """ Apply func to inventory to generate an image with numdim output bands
+        (kwargs passed to MapReduce, e.g. nproc, keepnodata, shared, outfile).
+        Unless nchunks row strips are requested, chunks are aligned to the blocks of the files
+        and sized to use memory MB each (default gippy chunk size).
+        If filename given the chunks are written to a new image as they complete
+        (at most window chunks in memory) and the image is returned instead of an array.
+        If cache each process opens the time series images once and reuses them for all chunks """
         if products is None:
             products = self.requested_products
         if readfunc is None:
             readfunc = lambda x: self.get_data(products=products, chunk=x)
+            if cache:
+                kwargs['initfunc'] = lambda: self.open_timeseries(products)
         inshape = self.data_size()
         outshape = [numbands, inshape[1], inshape[2]]
+        if nchunks is None:
+            if memory is None:
+                memory = gippy.Options.ChunkSize()
+            # same chunks used for reading and writing
+            chunks = MapReduce.plan((len(products) * len(self.dates), inshape[1], inshape[2]),
+                                    numbands=numbands, blocksize=self.block_size(), memory=memory)
+        else:
+            chunks = MapReduce.chunk(inshape, nchunks=nchunks)
         mr = MapReduce(inshape, outshape, readfunc, func, **kwargs)
-        mr.run(nchunks=nchunks)
+        if filename is not None:
+            imgout = self.new_image(filename, dtype=gippy.GDT_Float32, numbands=numbands, nodata=-32768)
+
+            def write(output, chunk):
+                ch = gippy.Recti(chunk[0], chunk[1], chunk[2], chunk[3])
+                for b in range(0, numbands):
+                    arr = output[b].astype('float32')
+                    arr[numpy.isnan(arr)] = -32768
+                    imgout[b].Write(arr, ch)
+            mr.stream(write, chunks=chunks, window=window)
+            return imgout
+        mr.run(chunks=chunks)
         return mr.assemble()
 
 
@@ -223,6 +365,7 @@ class DataInventory(Inventory):
         self.spatial = spatial
         self.temporal = temporal
         self.products = dataclass.RequestedProducts(products)
+        self.numprocs = kwargs.get('numprocs', 1)
 
         if fetch:
             try:
@@ -247,16 +390,33 @@ class DataInventory(Inventory):
         return sorted(self.dataclass.Asset._sensors.keys())
 
     def process(self, *args, **kwargs):
-        """ Process assets into requested products """
+        """ Process assets into requested products, using numprocs processes across tiles and dates """
         # TODO - some check on if any processing was done
         start = dt.now()
         VerboseOut('Processing [%s] on %s dates (%s files)' % (self.products, len(self.dates), self.numfiles), 3)
         if len(self.products.standard) > 0:
-            for date in self.dates:
-                try:
-                    self.data[date].process(*args, **kwargs)
-                except:
-                    VerboseOut(traceback.format_exc(), 4)
+            numprocs = kwargs.pop('numprocs', self.numprocs)
+            units = [(date, t) for date in self.dates for t in sorted(self.data[date].tiles)]
+            if numprocs > 1 and len(units) > 1:
+                # tiles processed in parallel, so each worker uses a single core
+                pool = multiprocessing.Pool(min(numprocs, len(units)), initializer=_process_init,
+                                            initargs=(self.data, args, kwargs, 1))
+                results = pool.map(_process_worker, units)
+                pool.close()
+                pool.join()
+            else:
+                _process_init(self.data, args, kwargs)
+                results = [_process_worker(unit) for unit in units]
+            failed = []
+            for (date, t), filenames, sensors, error in results:
+                self.data[date].tiles[t].filenames.update(filenames)
+                self.data[date].tiles[t].sensors.update(sensors)
+                if error is not None:
+                    failed.append((date, t, error))
+            VerboseOut('Processed %s tile-dates: %s succeeded, %s failed' %
+                       (len(units), len(units) - len(failed), len(failed)))
+            for date, t, error in failed:
+                VerboseOut('  %s %s: %s' % (date, t, error))
         if len(self.products.composite) > 0:
             self.dataclass.process_composites(self, self.products.composite, **kwargs)
         VerboseOut('Processing completed in %s' % (dt.now() - start), 2)
@@ -270,13 +430,32 @@ class DataInventory(Inventory):
         VerboseOut('  Dates: %s' % self.datestr)
         VerboseOut('  Products: %s' % self.products)
 
+        numprocs = kwargs.pop('numprocs', self.numprocs)
         dout = datadir
+        jobs = []
         for d in self.dates:
             if tree:
                 dout = os.path.join(datadir, d.strftime('%Y%j'))
-            self.data[d].mosaic(dout, **kwargs)
-
-        VerboseOut('Completed mosaic project in %s' % (dt.now() - start), 2)
+            jobs.extend([(d, p, dout) for p in self.products.products])
+        if numprocs > 1 and len(jobs) > 1:
+            # each mosaic writes its own file, each worker uses a single core
+            pool = multiprocessing.Pool(min(numprocs, len(jobs)), initializer=_process_init,
+                                        initargs=(self.data, (), kwargs, 1))
+            results = pool.map(_mosaic_worker, jobs)
+            pool.close()
+            pool.join()
+        else:
+            _process_init(self.data, (), kwargs)
+            results = [_mosaic_worker(job) for job in jobs]
+
+        failed = [(job, error) for job, fout, error in results if error is not None]
+        numcreated = len([fout for job, fout, error in results if fout is not None])
+        t = dt.now() - start
+        VerboseOut('Created %s mosaics (%s skipped, %s failed) in %s, %.2f mosaics/min' %
+                   (numcreated, len(jobs) - numcreated - len(failed), len(failed), t,
+                    numcreated * 60.0 / max(t.total_seconds(), 1e-6)))
+        for (d, p, dout), error in failed:
+            VerboseOut('  %s %s: %s' % (d, p, error))
 
     # def warptiles(self):
     #    """ Just copy or warp all tiles in the inventory """
@@ -21,9 +21,15 @@
 #   along with this program. If not, see <http://www.gnu.org/licenses/>
 ################################################################################
 
+import mmap
+import itertools
+from collections import deque
+from datetime import datetime
 import numpy
 import multiprocessing
 
+from gips.utils import VerboseOut
+
 
 def _worker(chunk):
     """ Worker function (has access to global variables set in _mr_init """
@@ -34,8 +40,11 @@ def _worker(chunk):
         data = data.reshape((1, shape[0], shape[1]))
         shape = data.shape
 
-    # make output array for this chunk
-    output = numpy.empty((outshape[0], shape[1], shape[2]))
+    # make output array for this chunk, or write directly into shared output
+    if outarr is not None:
+        output = outarr[:, chunk[1]:chunk[1] + chunk[3], chunk[0]:chunk[0] + chunk[2]]
+    else:
+        output = numpy.empty((outshape[0], shape[1], shape[2]))
     output[:] = numpy.nan
 
     # only run on valid pixel signatures unless keepnodata set
@@ -51,6 +60,8 @@ def _worker(chunk):
     if wfunc is not None:
         wfunc((output, chunk))
         return None
+    elif outarr is not None:
+        return None
     else:
         return output
 
@@ -58,12 +69,25 @@ def _worker(chunk):
 class MapReduce(object):
     """ General purpose class for performing map reduction functions """
 
-    def __init__(self, inshape, outshape, rfunc, pfunc, wfunc=None, nproc=2, keepnodata=False):
-        """ Create multiprocessing pool """
+    def __init__(self, inshape, outshape, rfunc, pfunc, wfunc=None, nproc=2, keepnodata=False,
+                 shared=False, outfile=None, initfunc=None):
+        """ Create multiprocessing pool, workers write output directly into a shared memory array
+        if shared or into a file backed array (numpy.memmap) if outfile given.
+        initfunc is called once in each process (e.g., to open files used by rfunc) """
         self.inshape = inshape
         self.outshape = outshape
+        self.nproc = nproc
+        self.wfunc = wfunc
+        self.output = None
+        if outfile is not None:
+            self.output = numpy.memmap(outfile, dtype='float64', mode='w+', shape=tuple(outshape))
+        elif shared:
+            # anonymous shared mapping, inherited by the forked workers
+            buf = mmap.mmap(-1, int(numpy.prod(outshape)) * numpy.dtype('float64').itemsize)
+            self.output = numpy.frombuffer(buf, dtype='float64').reshape(outshape)
         self.pool = multiprocessing.Pool(nproc, initializer=self._mr_init,
-                                         initargs=(inshape, outshape, rfunc, pfunc, wfunc, keepnodata))
+                                         initargs=(inshape, outshape, rfunc, pfunc, wfunc, keepnodata, self.output,
+                                                   initfunc))
 
     def run(self, nchunks=100, chunks=None):
         """ Run the multiprocessing pool """
@@ -73,23 +97,69 @@ class MapReduce(object):
             self.chunks = chunks
         self.dataparts = self.pool.map(_worker, self.chunks)
 
+    def stream(self, write, nchunks=100, chunks=None, window=None):
+        """ Run the multiprocessing pool, calling write(output, chunk) for each chunk in order as it completes.
+        At most window chunks (default 2 per process) are in flight, so memory is bounded by a few chunks.
+        With shared or file backed output, write is passed the view of the output for the chunk """
+        if self.wfunc is not None:
+            raise ValueError('MapReduce.stream cannot be used with a wfunc, chunks are written by the workers')
+        if chunks is None:
+            self.chunks = self.chunk(self.inshape, nchunks=nchunks)
+        else:
+            self.chunks = chunks
+        if window is None:
+            window = 2 * self.nproc
+        start = datetime.now()
+        numchunks = len(self.chunks)
+        numdone = 0
+        nbytes = 0
+        remaining = iter(self.chunks)
+        pending = deque()
+        while True:
+            for ch in itertools.islice(remaining, max(window - len(pending), 0)):
+                pending.append((ch, self.pool.apply_async(_worker, (ch,))))
+            if len(pending) == 0:
+                break
+            ch, result = pending.popleft()
+            output = result.get()
+            if self.output is not None:
+                # workers wrote the chunk into the shared output
+                output = self.output[:, ch[1]:ch[1] + ch[3], ch[0]:ch[0] + ch[2]]
+            write(output, ch)
+            numdone = numdone + 1
+            nbytes = nbytes + output.nbytes
+            # report every 10%
+            if (numdone * 10) // numchunks != ((numdone - 1) * 10) // numchunks:
+                secs = max((datetime.now() - start).total_seconds(), 1e-6)
+                VerboseOut('Chunk %s of %s: %.2f chunks/s, %.2f MB/s' %
+                           (numdone, numchunks, numdone / secs, nbytes / secs / 1024.0 / 1024.0))
+        VerboseOut('Wrote %s chunks in %s' % (numchunks, datetime.now() - start), 2)
+
     def assemble(self):
         """ Reassemble output parts into single array """
+        if self.output is not None:
+            # already written by workers
+            if isinstance(self.output, numpy.memmap):
+                self.output.flush()
+            return self.output.squeeze()
         dataout = numpy.empty(self.outshape)
         for i, ch in enumerate(self.chunks):
             dataout[:, ch[1]:ch[1] + ch[3], ch[0]:ch[0] + ch[2]] = self.dataparts[i]
         return dataout.squeeze()
 
     @staticmethod
-    def _mr_init(_inshape, _outshape, _rfunc, _pfunc, _wfunc, _keepnodata):
+    def _mr_init(_inshape, _outshape, _rfunc, _pfunc, _wfunc, _keepnodata, _outarr=None, _initfunc=None):
         """ Initializer sets globals for processes """
-        global inshape, outshape, rfunc, pfunc, wfunc, keepnodata
+        global inshape, outshape, rfunc, pfunc, wfunc, keepnodata, outarr
         inshape = _inshape
         outshape = _outshape
         rfunc = _rfunc
         pfunc = _pfunc
         wfunc = _wfunc
         keepnodata = _keepnodata
+        outarr = _outarr
+        if _initfunc is not None:
+            _initfunc()
 
     @staticmethod
     def chunk(shape, nchunks=100):
@@ -98,10 +168,38 @@ class MapReduce(object):
         remainder = shape[1] - chunksz * nchunks
         chszs = [chunksz] * (nchunks - remainder) + [chunksz + 1] * remainder
         chunks = []
+        y = 0
         for ichunk in range(nchunks):
             # This is being inverted because gippy is X x Y, whereas numpy is Y x X
-            #chunks.append(gippy.Recti(0, sum(chszs[:ichunk]), datasz[2], chszs[ichunk]))
-            chunks.append([0, sum(chszs[:ichunk]), shape[2], chszs[ichunk]])
+            #chunks.append(gippy.Recti(0, y, datasz[2], chszs[ichunk]))
+            chunks.append([0, y, shape[2], chszs[ichunk]])
+            y = y + chszs[ichunk]
+        return chunks
+
+    @staticmethod
+    def plan(shape, numbands=1, blocksize=None, memory=128.0):
+        """ Create chunks of input data size (B x Y x X) aligned to the native blocks (x, y) of the
+        input files, each using about memory MB for the input and numbands output float64 arrays """
+        ysize, xsize = shape[1], shape[2]
+        if blocksize is None:
+            blocksize = (xsize, 1)
+        bx, by = min(blocksize[0], xsize), min(blocksize[1], ysize)
+        # number of blocks across and down the image, and per chunk
+        nx = -(-xsize // bx)
+        ny = -(-ysize // by)
+        pixels = int(memory * 1024 * 1024 / ((shape[0] + numbands) * 8.0))
+        nblocks = max(pixels // (bx * by), 1)
+        if nblocks >= nx:
+            # whole rows of blocks
+            cols = nx
+        else:
+            cols = max(int(numpy.sqrt(nblocks)), 1)
+        rows = max(min(nblocks // cols, ny), 1)
+        width, height = cols * bx, rows * by
+        chunks = []
+        for y in range(0, ysize, height):
+            for x in range(0, xsize, width):
+                chunks.append([x, y, min(width, xsize - x), min(height, ysize - y)])
         return chunks
 
     @staticmethod
@@ -115,14 +213,14 @@ class MapReduce(object):
         return (inshape, outshape)
 
 
-def map_reduce_array(arrin, pfunc, numbands=1, nchunks=100, nproc=2, keepnodata=False):
+def map_reduce_array(arrin, pfunc, numbands=1, nchunks=100, nproc=2, keepnodata=False, shared=False):
     """ Apply user defined pfunc to a numpy array using multiple processors """
     (inshape, outshape) = MapReduce.get_shapes(arrin, numbands)
 
     # read data from global input array
     rfunc = lambda chunk: arrin[:, chunk[1]:chunk[1] + chunk[3], chunk[0]:chunk[0] + chunk[2]]
 
-    mr = MapReduce(inshape, outshape, rfunc=rfunc, pfunc=pfunc, nproc=nproc, keepnodata=keepnodata)
+    mr = MapReduce(inshape, outshape, rfunc=rfunc, pfunc=pfunc, nproc=nproc, keepnodata=keepnodata, shared=shared)
     mr.run(nchunks=nchunks)
     return mr.assemble()
 
@@ -27,7 +27,6 @@ import argparse
 import traceback
 
 from gips.utils import data_sources
-import gippy
 
 
 class GIPSParser(argparse.ArgumentParser):
@@ -116,6 +115,8 @@ class GIPSParser(argparse.ArgumentParser):
         group.add_argument('--notld', help=h, default=False, action='store_true')
         h = 'Create project directories in tree form'
         group.add_argument('--tree', help=h, default=False, action='store_true')
+        h = 'Create VRT files referencing repository data instead of copying it'
+        group.add_argument('--vrt', help=h, default=False, action='store_true')
         self.parent_parsers.append(parser)
         return parser
 
@@ -155,6 +156,7 @@ class GIPSParser(argparse.ArgumentParser):
 
 def set_gippy_options(args):
     """ Set gippy options from parsed command line arguments """
+    import gippy
     if 'verbose' in args:
         gippy.Options.SetVerbose(args.verbose)
     if 'format' in args:
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+
+from gips import __version__ as gipsversion
+from gips.parsers import GIPSParser
+from gips.utils import Colors, VerboseOut, import_data_class
+
+
+def print_report(errors):
+    """ Print maximum absolute and relative interpolation errors for each band """
+    print Colors.UNDER + '{:<10}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'Band', 'T', 'Lu', 'Ld', 'T %', 'Lu %', 'Ld %') + Colors.OFF
+    for band in sorted(errors):
+        abserr, relerr = errors[band]
+        print '{:<10}{:>10.5f}{:>10.5f}{:>10.5f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+            band, abserr[0], abserr[1], abserr[2], relerr[0] * 100, relerr[1] * 100, relerr[2] * 100)
+
+
+def main():
+    title = Colors.BOLD + 'GIPS 6S Lookup Tables (v%s)' % gipsversion + Colors.OFF
+
+    # argument parsing
+    parser0 = GIPSParser(description=title, datasources=False)
+    parser0.add_default_parser()
+    subparser = parser0.add_subparsers(dest='command')
+    h = 'Run 6S over grid of geometry, AOD, atmospheric model and day of year and save lookup table'
+    p = subparser.add_parser('build', help=h)
+    p.add_argument('--numprocs', help='Number of processes running 6S', default=2, type=int)
+    p.add_argument('--validate', help='Number of random points to validate table against', default=20, type=int)
+    for axis in ['solarzenith', 'viewzenith', 'azimuth', 'aod', 'doy']:
+        p.add_argument('--%s' % axis, help='Values of %s in table' % axis, nargs='*', type=float, default=None)
+    p = subparser.add_parser('validate', help='Report interpolation error of lookup table against 6S runs')
+    p.add_argument('--numprocs', help='Number of processes running 6S', default=2, type=int)
+    p.add_argument('--validate', help='Number of random points to validate table against', default=20, type=int)
+    for p in subparser.choices.values():
+        p.add_argument('repo', help='Data source (default landsat)', nargs='?', default='landsat')
+        p.add_argument('--sensors', help='Sensors (default to all)', nargs='*', default=None)
+    args = parser0.parse_args()
+
+    try:
+        print title
+        from gips.atmosphere import SIXSLUT
+        cls = import_data_class(args.repo)
+        sensors = args.sensors if args.sensors else sorted(cls.Asset._sensors.keys())
+        for sensor in sensors:
+            filename = cls.sixs_lut(sensor)
+            if args.command == 'build':
+                bands, wavelengths = cls.sixs_bands(sensor)
+                axes = {a: getattr(args, a) for a in ['solarzenith', 'viewzenith', 'azimuth', 'aod', 'doy']
+                        if getattr(args, a) is not None}
+                lut = SIXSLUT.build(filename, sensor, bands, wavelengths, numprocs=args.numprocs, **axes)
+                print '%s: built %s' % (sensor, filename)
+            else:
+                lut = SIXSLUT(filename)
+            if args.validate > 0:
+                print '%s: interpolation error at %s random points' % (sensor, args.validate)
+                print_report(lut.validate(args.validate, numprocs=args.numprocs))
+    except Exception, e:
+        import traceback
+        VerboseOut(traceback.format_exc(), 4)
+        print 'Lookup table error: %s' % e
+
+
+if __name__ == "__main__":
+    main()
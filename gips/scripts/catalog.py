@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+from gips import __version__ as gipsversion
+from gips.parsers import GIPSParser
+from gips.catalog import Catalog
+from gips.utils import Colors, VerboseOut, data_sources, import_data_class
+
+
+def main():
+    title = Colors.BOLD + 'GIPS Repository Catalog (v%s)' % gipsversion + Colors.OFF
+
+    # argument parsing
+    parser0 = GIPSParser(description=title, datasources=False)
+    parser0.add_default_parser()
+    subparser = parser0.add_subparsers(dest='command')
+    p = subparser.add_parser('rebuild', help='Rebuild catalog by scanning repository')
+    p.add_argument('repos', help='Repositories to catalog (default to all)', nargs='*')
+    p = subparser.add_parser('refresh', help='Update catalog with repository directories changed since last refresh')
+    p.add_argument('repos', help='Repositories to catalog (default to all)', nargs='*')
+    args = parser0.parse_args()
+
+    try:
+        print title
+        repos = args.repos if len(args.repos) > 0 else sorted(data_sources().keys())
+        for repo in repos:
+            cls = import_data_class(repo)
+            if args.command == 'rebuild':
+                Catalog.rebuild(cls)
+            elif args.command == 'refresh':
+                Catalog.refresh(cls)
+    except Exception, e:
+        import traceback
+        VerboseOut(traceback.format_exc(), 4)
+        print 'Catalog error: %s' % e
+
+
+if __name__ == "__main__":
+    main()
@@ -25,7 +25,6 @@ from gips import __version__ as gipsversion
 from gips.parsers import GIPSParser
 from gips.core import SpatialExtent, TemporalExtent
 from gips.utils import Colors, VerboseOut, open_vector, import_data_class
-from gips.inventory import DataInventory
 
 
 def main():
@@ -36,11 +35,16 @@ def main():
     parser = parser0.add_inventory_parser()
     group = parser.add_argument_group('inventory display')
     group.add_argument('--md', help='Show dates using MM-DD', action='store_true', default=False)
+    h = 'Update repository catalog with any changed directories before inventory'
+    group.add_argument('--refresh', help=h, action='store_true', default=False)
     args = parser0.parse_args()
+    from gips.inventory import DataInventory
 
     try:
         print title
         cls = import_data_class(args.command)
+        if args.refresh:
+            cls.Asset.Repository.refresh_catalog()
 
         extents = SpatialExtent.factory(cls, args.site, args.key, args.where, 
                                         args.tiles, args.pcov, args.ptile)
@@ -23,9 +23,7 @@
 
 import os
 
-import gippy
 from gips.parsers import GIPSParser
-from gips.inventory import ProjectInventory
 from gips.utils import Colors, VerboseOut, basename
 
 __version__ = '0.1.0'
@@ -48,6 +46,8 @@ def main():
     #parser0.add_argument('-i', '--invert', help='Invert mask (0->1, 1->0)', default=False, action='store_true')
     #parser0.add_argument('--value', help='Mask == val', default=1)
     args = parser0.parse_args()
+    import gippy
+    from gips.inventory import ProjectInventory
 
     # TODO - check that at least 1 of filemask or pmask is supplied
 
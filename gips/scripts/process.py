@@ -25,7 +25,6 @@ from gips import __version__
 from gips.parsers import GIPSParser
 from gips.core import SpatialExtent, TemporalExtent
 from gips.utils import Colors, VerboseOut, open_vector, import_data_class
-from gips.inventory import DataInventory
 
 
 def main():
@@ -36,6 +35,7 @@ def main():
     parser0.add_inventory_parser()
     parser0.add_process_parser()
     args = parser0.parse_args()
+    from gips.inventory import DataInventory
 
     try:
         print title
@@ -26,7 +26,6 @@ from gips import __version__
 from gips.parsers import GIPSParser
 from gips.core import SpatialExtent, TemporalExtent
 from gips.utils import Colors, VerboseOut, import_data_class
-from gips.inventory import DataInventory, ProjectInventory
 
 
 def main():
@@ -39,6 +38,7 @@ def main():
     parser0.add_project_parser()
     parser0.add_warp_parser()
     args = parser0.parse_args()
+    from gips.inventory import DataInventory, ProjectInventory
 
     try:
         print title
@@ -61,7 +61,7 @@ def main():
             datadir = os.path.join(tld, extent.site.Value())
             if inv.numfiles > 0:
                 inv.mosaic(datadir=datadir, tree=args.tree, overwrite=args.overwrite,
-                           res=args.res, interpolation=args.interpolation, crop=args.crop)
+                           res=args.res, interpolation=args.interpolation, crop=args.crop, vrt=args.vrt)
             if not args.tree:
                 inv = ProjectInventory(datadir)
                 inv.pprint()
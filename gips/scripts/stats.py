@@ -23,9 +23,7 @@
 
 import os
 
-import gippy
 from gips.parsers import GIPSParser
-from gips.inventory import ProjectInventory
 from gips.utils import Colors, VerboseOut, basename
 
 __version__ = '0.1.0'
@@ -38,6 +36,7 @@ def main():
     parser0.add_projdir_parser()
     group = parser0.add_argument_group('masking options')
     args = parser0.parse_args()
+    from gips.inventory import ProjectInventory
 
     # TODO - check that at least 1 of filemask or pmask is supplied
 
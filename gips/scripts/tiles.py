@@ -26,7 +26,6 @@ from gips import __version__
 from gips.parsers import GIPSParser
 from gips.core import SpatialExtent, TemporalExtent
 from gips.utils import Colors, VerboseOut, mkdir, open_vector, import_data_class
-from gips.inventory import DataInventory
 
 
 def main():
@@ -39,6 +38,7 @@ def main():
     parser0.add_project_parser()
     parser0.add_warp_parser()
     args = parser0.parse_args()
+    from gips.inventory import DataInventory
 
     try:
         print title
@@ -61,10 +61,13 @@ def main():
             for date in inv.dates:
                 for tid in inv[date].tiles:
                     # make sure back-end tiles are processed
-                    inv[date].tiles[tid].process(args.products, overwrite=False)
+                    try:
+                        inv[date].tiles[tid].process(args.products, overwrite=False)
+                    finally:
+                        inv[date].tiles[tid].catalog_products()
                     # warp the tiles
-                    inv[date].tiles[tid].copy(tld, args.products, inv.spatial.site,
-                                              args.res, args.interpolation, args.crop, args.overwrite, args.tree)
+                    inv[date].tiles[tid].copy(tld, args.products, inv.spatial.site, args.res, args.interpolation,
+                                              args.crop, args.overwrite, args.tree, args.vrt, args.numprocs)
 
     except Exception, e:
         import traceback
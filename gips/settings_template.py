@@ -39,6 +39,10 @@ DATABASES = {
 }
 
 
+# Directory to keep rasterized site masks between runs (not kept if empty)
+MASKCACHE = ''
+
+
 REPOS = {
     'aod': {
         'repository': '$TLD/aod',
@@ -47,6 +51,7 @@ REPOS = {
         'repository': '$TLD/landsat',
         # Landsat specific settings
         '6S': False,            # atm correction for VIS/NIR/SWIR bands
+        '6Slut': False,         # interpolate 6S results from lookup tables (built with gips_atmlut)
         'MODTRAN': False,       # atm correction for LWIR
         'extract': False,       # extract files from tar.gz before processing instead of direct access
     },
@@ -77,6 +82,8 @@ REPOS = {
     'dataname': {
         # path to driver directory location (default to gips/data/dataname/ if not given)
         'driver': '',
+        # description shown in command line help (otherwise driver is imported to get it)
+        'description': '',
         # path to top level directory of data
         'repository': '',
         # override location of tiles vector (default to gips/data/dataname/tiles.shp)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+""" Checks that gips_ scripts start without loading drivers or geospatial libraries """
+
+""" Checks of the repository catalog against a repository of empty directories """
+
+import os
+import datetime
+
+import gips.catalog
+from gips.catalog import Catalog
+
+dates = [datetime.date(2012, 9, d) for d in [10, 11, 12]]
+
+
+class Repository(object):
+    root = None
+
+    @classmethod
+    def find_tiles(cls):
+        return ['012030']
+
+    @classmethod
+    def find_dates(cls, tile):
+        return [datetime.datetime.strptime(d, '%Y%j').date() for d in os.listdir(cls.data_path(tile))]
+
+    @classmethod
+    def data_path(cls, tile, date=''):
+        path = os.path.join(cls.root, tile)
+        if date != '':
+            path = os.path.join(path, date.strftime('%Y%j'))
+        return path
+
+
+class Asset(object):
+    Repository = Repository
+
+
+class Data(object):
+    """ Data with a single product for each date, except a bad date directory that cannot be read """
+    Asset = Asset
+    name = 'test'
+    bad = None
+
+    def __init__(self, tile, date):
+        if date == self.bad:
+            raise Exception('unreadable directory')
+        self.id = tile
+        self.date = date
+        self.assets = {}
+        self.filenames = {('LE7', 'ndvi'): Repository.data_path(tile, date) + '/ndvi.tif'}
+
+
+def repository(tmpdir, monkeypatch):
+    # messages are not checked, so leave gippy verbosity out of it
+    monkeypatch.setattr(gips.catalog, 'VerboseOut', lambda obj, level=1: None)
+    Repository.root = str(tmpdir)
+    for date in dates:
+        os.makedirs(Repository.data_path('012030', date))
+    return Catalog(str(tmpdir.join(Catalog.filename)))
+
+
+def test_refresh_skips_bad_directory(tmpdir, monkeypatch):
+    catalog = repository(tmpdir, monkeypatch)
+    Data.bad = dates[1]
+    assert catalog._refresh(Data) == 2
+    assert Catalog.scanning is False
+    assert catalog.dates(['012030']) == [dates[0], dates[2]]
+    # directory that failed is scanned again on next refresh
+    Data.bad = None
+    assert catalog._refresh(Data) == 1
+    assert catalog.dates(['012030']) == dates
+
+
+def test_add_products(tmpdir, monkeypatch):
+    catalog = repository(tmpdir, monkeypatch)
+    catalog.add_products('012030', dates[0], [('LE7', 'ndvi', 'a.tif'), ('LE7', 'ref', 'b.tif')])
+    assert sorted(catalog.products('012030', dates[0])) == [('LE7', 'ndvi', 'a.tif'), ('LE7', 'ref', 'b.tif')]
+    assert catalog.count() == (0, 2)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+""" Checks that a cube is only used for the files it was written from """
+
+import os
+import json
+import datetime
+
+import pytest
+
+pytest.importorskip('gippy')
+pytest.importorskip('gdal')
+
+from gips.cube import Cube
+
+dates = [datetime.date(2012, 9, 10), datetime.date(2012, 9, 26)]
+
+
+def test_has_changed_files(tmpdir):
+    filenames = {}
+    for d in dates:
+        filenames[d] = str(tmpdir.join('%s_ndvi.tif' % d.strftime('%Y%j')))
+        with open(filenames[d], 'w') as f:
+            f.write('original')
+    meta = {
+        'dates': [d.strftime(Cube._datefmt) for d in dates],
+        'shape': [10, 10],
+        'blocksize': [256, 256],
+        'products': {'ndvi': {'sources': {d.strftime(Cube._datefmt): Cube._stamp(filenames[d]) for d in dates}}},
+    }
+    with open(str(tmpdir.join(Cube.filename)), 'w') as f:
+        json.dump(meta, f)
+    cube = Cube.open(str(tmpdir))
+    assert cube.has('ndvi', dates)
+    assert cube.has('ndvi', dates, filenames)
+    assert not cube.has('ndvi', [datetime.date(2012, 9, 11)], filenames)
+    assert not cube.has('ref', dates, filenames)
+    # reprocessed file
+    with open(filenames[dates[1]], 'w') as f:
+        f.write('reprocessed')
+    assert cube.has('ndvi', dates[:1], filenames)
+    assert not cube.has('ndvi', dates, filenames)
+    os.remove(filenames[dates[0]])
+    assert not cube.has('ndvi', dates[:1], filenames)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+""" Checks of processing tiles in an inventory """
+
+import datetime
+
+import pytest
+
+pytest.importorskip('gippy')
+pytest.importorskip('gdal')
+
+from gips import inventory
+
+
+class RequestedProducts(object):
+    products = ['ndvi-toa', 'ref-toa']
+    standard = {'ndvi-toa': ['ndvi', 'toa'], 'ref-toa': ['ref', 'toa']}
+
+
+class Data(object):
+    """ Tile that logs and skips products listed in skip """
+    def __init__(self, skip=[]):
+        self.skip = skip
+        self.filenames = {}
+        self.sensors = {}
+
+    def process(self, products, **kwargs):
+        for p in products:
+            if p not in self.skip:
+                self.filenames[('LC8', p)] = '%s.tif' % p
+                self.sensors[p] = 'LC8'
+
+    @property
+    def products(self):
+        return sorted([k[1] for k in self.filenames.keys()])
+
+    def catalog_products(self):
+        pass
+
+
+class Tiles(dict):
+    products = RequestedProducts()
+
+
+def test_missing_products_fail():
+    date = datetime.date(2016, 1, 1)
+    tiles = Tiles({'012030': Data(), '012031': Data(skip=['ref-toa'])})
+    inventory._process_init({date: tiles}, [], {})
+    assert inventory._process_worker((date, '012030'))[3] is None
+    assert inventory._process_worker((date, '012031'))[3] == 'products not created: ref-toa'
+
+
+def test_timeseries_opened_once(monkeypatch):
+    """ Time series kept open by open_timeseries are reused for every chunk """
+    inv = inventory.ProjectInventory.__new__(inventory.ProjectInventory)
+    inv.data = {datetime.date(2016, 1, 1): None, datetime.date(2016, 1, 2): None}
+    inv.requested_products = ['ndvi', 'lswi']
+    inv.cube = None
+    inv._images = {}
+    opened = []
+    monkeypatch.setattr(inv, 'get_timeseries', lambda product, dates: opened.append(product) or object())
+    for i in range(3):
+        inv._timeseries('ndvi', inv.dates)
+    assert opened == ['ndvi'] * 3
+    inv.open_timeseries()
+    opened = []
+    for i in range(3):
+        for p in inv.requested_products:
+            inv._timeseries(p, inv.dates)
+    assert opened == []
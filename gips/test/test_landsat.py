@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+""" Checks that gips_ scripts start without loading drivers or geospatial libraries """
+
+""" Checks that landsat products read, transformed and written in windows match whole scene processing """
+
+import numpy
+import pytest
+
+gippy = pytest.importorskip('gippy')
+from gips.utils import chunks
+from gips.data.landsat.landsat import landsatAsset, _tcap, _volref
+
+bands = ['BLUE', 'GREEN', 'RED', 'NIR', 'SWIR1', 'SWIR2']
+# chunk sizes (MB) giving a single window, and windows of one row
+whole, row = 1024.0, 0.001
+
+
+def reflectance(tmpdir):
+    """ Random reflectance image with some nodata pixels """
+    rand = numpy.random.RandomState(0)
+    img = gippy.GeoImage(str(tmpdir.join('refl.tif')), 97, 53, len(bands), gippy.GDT_Float32)
+    img.SetNoData(-32768)
+    for i, band in enumerate(bands):
+        img.SetBandName(band, i + 1)
+        arr = rand.uniform(0.0, 0.6, (53, 97)).astype('float32')
+        arr[rand.uniform(size=(53, 97)) < 0.05] = -32768
+        img[i].Write(arr)
+    return img
+
+
+def assert_identical(img1, img2):
+    assert img1.NumBands() == img2.NumBands()
+    for b in range(0, img1.NumBands()):
+        assert numpy.array_equal(img1[b].ReadRaw(), img2[b].ReadRaw())
+
+
+def test_tcap_windowed(tmpdir):
+    img = reflectance(tmpdir)
+    assert len(chunks(img, numarrays=len(bands) + 2, chunksize=row)) == img.YSize()
+    coef = landsatAsset._tcapcoef
+    assert_identical(_tcap(img, str(tmpdir.join('whole')), coef, chunksize=whole),
+                     _tcap(img, str(tmpdir.join('windowed')), coef, chunksize=row))
+
+
+def test_volref_windowed(tmpdir):
+    img = reflectance(tmpdir)
+    vbands = [b for b in bands if b != 'SWIR1']
+    assert_identical(_volref(img, str(tmpdir.join('whole')), vbands, chunksize=whole),
+                     _volref(img, str(tmpdir.join('windowed')), vbands, chunksize=row))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+""" Checks of MapReduce chunking and streamed output """
+
+import numpy
+import pytest
+
+from gips import mapreduce
+from gips.mapreduce import MapReduce
+
+arrin = numpy.random.rand(4, 300, 200)
+arrin[:, 10:20, 30:40] = numpy.nan
+inshape, outshape = MapReduce.get_shapes(arrin, 2)
+
+
+def rfunc(chunk):
+    return arrin[:, chunk[1]:chunk[1] + chunk[3], chunk[0]:chunk[0] + chunk[2]]
+
+
+def pfunc(data):
+    return numpy.vstack([data.mean(axis=0), data.max(axis=0)])
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    # progress messages are not checked, so leave gippy verbosity out of it
+    monkeypatch.setattr(mapreduce, 'VerboseOut', lambda obj, level=1: None)
+
+
+def expected():
+    out = numpy.empty(outshape)
+    out[:] = numpy.nan
+    valid = numpy.all(~numpy.isnan(arrin), axis=0)
+    out[:, valid] = pfunc(arrin[:, valid])
+    return out
+
+
+def test_plan():
+    """ Chunks are aligned to blocks and cover the image once """
+    chunks = MapReduce.plan(inshape, numbands=2, blocksize=(200, 16), memory=0.1)
+    assert len(chunks) > 1
+    count = numpy.zeros(inshape[1:], dtype='int')
+    for x, y, width, height in chunks:
+        assert y % 16 == 0 and (height % 16 == 0 or y + height == inshape[1])
+        count[y:y + height, x:x + width] += 1
+    assert numpy.all(count == 1)
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_stream_to_file(tmpdir, shared):
+    """ Chunks streamed in order to a file backed array, with and without shared output """
+    chunks = MapReduce.plan(inshape, numbands=2, blocksize=(200, 16), memory=0.1)
+    filename = str(tmpdir.join('out.dat'))
+    out = numpy.memmap(filename, dtype='float64', mode='w+', shape=tuple(outshape))
+    written = []
+
+    def write(output, chunk):
+        out[:, chunk[1]:chunk[1] + chunk[3], chunk[0]:chunk[0] + chunk[2]] = output
+        written.append(chunk)
+
+    mr = MapReduce(inshape, outshape, rfunc, pfunc, nproc=2, shared=shared)
+    mr.stream(write, chunks=chunks, window=3)
+    mr.pool.close()
+    mr.pool.join()
+    out.flush()
+    assert written == chunks
+    result = numpy.memmap(filename, dtype='float64', mode='r', shape=tuple(outshape))
+    assert numpy.allclose(result, expected(), equal_nan=True)
+
+
+def test_stream_with_wfunc():
+    mr = MapReduce(inshape, outshape, rfunc, pfunc, wfunc=lambda x: None, nproc=1)
+    with pytest.raises(ValueError):
+        mr.stream(lambda output, chunk: None)
+    mr.pool.close()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+""" Checks that gips_ scripts start without loading drivers or geospatial libraries """
+
+import os
+import re
+import sys
+import subprocess
+
+import gips.data
+
+# libraries only imported once a command is run
+heavy = ['gippy', 'gdal', 'ogr', 'osr', 'osgeo', 'shapely', 'Py6S']
+
+
+def test_script_imports():
+    """ Modules imported by scripts before parsing arguments do not load heavy libraries """
+    code = ('import sys\n'
+            'import gips.parsers, gips.utils, gips.core, gips.catalog, gips.data\n'
+            'print(" ".join(sorted(set(m.split(".")[0] for m in sys.modules))))\n')
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=root)
+    modules = subprocess.check_output([sys.executable, '-c', code], env=env).decode().split()
+    assert [m for m in heavy if m in modules] == []
+
+
+def test_driver_manifest():
+    """ Every included driver is in the manifest and takes its description from it """
+    datadir = os.path.dirname(os.path.abspath(gips.data.__file__))
+    names = [d for d in os.listdir(datadir) if os.path.exists(os.path.join(datadir, d, d + '.py'))]
+    assert sorted(names) == sorted(gips.data.drivers.keys())
+    for name in names:
+        with open(os.path.join(datadir, name, name + '.py')) as f:
+            source = f.read()
+        assert re.search(r"\n    description = drivers\['%s'\]\n" % name, source), name
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+""" Checks that gips_ scripts start without loading drivers or geospatial libraries """
+
+""" Checks of tile coverage from regular tile grids """
+
+import pytest
+
+pytest.importorskip('gippy')
+pytest.importorskip('osgeo')
+from shapely.geometry import box
+from gips.data.core import TileGrid
+
+wgs84 = ('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],'
+         'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]')
+
+
+def test_grid_coverage():
+    grid = TileGrid(wgs84, origin=(-180.0, 90.0), size=(10.0, 10.0), shape=(36, 18))
+    tiles = grid.coverage(box(-5.0, 0.0, 5.0, 5.0))
+    assert sorted(tiles.keys()) == ['h17v08', 'h18v08']
+    assert tiles['h17v08'] == (0.5, 0.25)
+
+
+def test_single_tile_coverage():
+    """ Single global tile is used in full, whatever the size of the site """
+    grid = TileGrid(wgs84, origin=(-180.0, 90.0), size=(360.0, 180.0), shape=(1, 1), tileid='')
+    assert grid.coverage(box(-71.0, 43.0, -70.9, 43.1)) == {'': (1, 1)}
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+################################################################################
+#    GIPS: Geospatial Image Processing System
+#
+#    AUTHOR: Matthew Hanson
+#    EMAIL:  matt.a.hanson@gmail.com
+#
+#    Copyright (C) 2014 Applied Geosolutions
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>
+################################################################################
+
+""" Checks of settings loaded once per process """
+
+import os
+
+from gips import utils
+
+
+def test_settings_cached(tmpdir, monkeypatch):
+    """ Settings are loaded once and reloaded only when the settings file changes """
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setattr(utils, '_settings', {})
+    userfile = tmpdir.mkdir('.gips').join('settings.py')
+    userfile.write("EMAIL = 'first@example.com'\n")
+    os.utime(str(userfile), (1000000000, 1000000000))
+    src = utils.settings()
+    assert src.EMAIL == 'first@example.com'
+    assert utils.settings() is src
+    userfile.write("EMAIL = 'second@example.com'\n")
+    os.utime(str(userfile), (1000000100, 1000000100))
+    assert utils.settings().EMAIL == 'second@example.com'
@@ -29,7 +29,7 @@ import traceback
 import gippy
 from gippy.algorithms import CookieCutter
 from gips.core import SpatialExtent
-from gips.utils import VerboseOut, Colors, mosaic, mkdir
+from gips.utils import VerboseOut, Colors, mosaic, vrt_mosaic, mkdir
 
 
 class Tiles(object):
@@ -74,35 +74,49 @@ class Tiles(object):
 
     def process(self, *args, **kwargs):
         """ Calls process for each tile """
-        [t.process(*args, products=self.products.products, **kwargs) for t in self.tiles.values()]
+        for t in self.tiles.values():
+            try:
+                t.process(*args, products=self.products.products, **kwargs)
+            finally:
+                t.catalog_products()
 
-    def mosaic(self, datadir, res=None, interpolation=0, crop=False, overwrite=False):
+    def mosaic(self, datadir, res=None, interpolation=0, crop=False, overwrite=False, vrt=False):
         """ Combine tiles into a single mosaic, warp if res provided """
-        if self.spatial.site is None:
-            raise Exception('Site required for creating mosaics')
         start = datetime.now()
-        mkdir(datadir)
-        bname = self.date.strftime('%Y%j')
         for product in self.products.products:
-            sensor = self.which_sensor(product)
-            if sensor is None:
-                continue
-            # TODO - this is assuming a tif file.  Use gippy FileExtension function when it is exposed
-            fout = os.path.join(datadir, '%s_%s_%s' % (bname, sensor, product)) + '.tif'
-            if not os.path.exists(fout) or overwrite:
-                try:
-                    filenames = [self.tiles[t].filenames[(sensor, product)] for t in self.tiles]
-                    images = gippy.GeoImages(filenames)
-                    if self.spatial.site is not None and res is not None:
-                        CookieCutter(images, self.spatial.site, fout, res[0], res[1], crop, interpolation)
-                    else:
-                        mosaic(images, fout, self.spatial.site)
-                except Exception, e:
-                    VerboseOut(traceback.format_exc(), 4)
-                    VerboseOut("Error mosaicking %s: %s" % (fout, e))
+            try:
+                self.mosaic_product(datadir, product, res, interpolation, crop, overwrite, vrt)
+            except Exception, e:
+                VerboseOut(traceback.format_exc(), 4)
+                VerboseOut("Error mosaicking %s: %s" % (product, e))
         t = datetime.now() - start
         VerboseOut('%s: created project files for %s tiles in %s' % (self.date, len(self.tiles), t), 2)
 
+    def mosaic_product(self, datadir, product, res=None, interpolation=0, crop=False, overwrite=False, vrt=False):
+        """ Combine tiles of a product into a single mosaic, warp if res provided. If vrt create
+        a VRT referencing the tiles (cropped to site extent and cutline) instead of copying data.
+        Return output filename, or None if product not available or output exists and not overwrite """
+        if self.spatial.site is None:
+            raise Exception('Site required for creating mosaics')
+        sensor = self.which_sensor(product)
+        if sensor is None:
+            return None
+        mkdir(datadir)
+        bname = self.date.strftime('%Y%j')
+        # TODO - this is assuming a tif file.  Use gippy FileExtension function when it is exposed
+        fout = os.path.join(datadir, '%s_%s_%s' % (bname, sensor, product)) + ('.vrt' if vrt else '.tif')
+        if os.path.exists(fout) and not overwrite:
+            return None
+        filenames = [self.tiles[t].filenames[(sensor, product)] for t in self.tiles]
+        images = gippy.GeoImages(filenames)
+        if vrt:
+            vrt_mosaic(images, fout, self.spatial.site, res, interpolation)
+        elif self.spatial.site is not None and res is not None:
+            CookieCutter(images, self.spatial.site, fout, res[0], res[1], crop, interpolation)
+        else:
+            mosaic(images, fout, self.spatial.site)
+        return fout
+
     def asset_coverage(self):
         """ Calculates % coverage of site for each asset """
         asset_coverage = {}
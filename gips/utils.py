@@ -23,12 +23,16 @@
 
 import os
 import errno
-import gippy
-from gippy import GeoVector
 import tempfile
 import commands
 import shutil
 import traceback
+import math
+import json
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+import numpy
 
 
 class Colors():
@@ -59,6 +63,7 @@ class Colors():
 
 
 def VerboseOut(obj, level=1):
+    import gippy
     if gippy.Options.Verbose() >= level:
         #pprint.PrettyPrinter().pprint(obj)
         if not isinstance(obj, (list, tuple)):
@@ -122,19 +127,38 @@ def link(src, dst, hard=False):
 # Settings functions
 ##############################################################################
 
+# settings and data drivers loaded in this process, keyed by file modification times
+_settings = {}
+_drivers = {}
+
+
+def _mtime(filename):
+    """ Modification time of file, None if it does not exist """
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
 def settings():
-    """ Retrieve GIPS settings - first from user, then from system """
+    """ Retrieve GIPS settings - first from user, then from system (reloaded only if changed) """
     import imp
+    userfile = os.path.expanduser('~/.gips/settings.py')
+    key = (_mtime(userfile), _mtime(os.path.join(os.path.dirname(__file__), 'settings.py')))
+    if _settings.get('key') == key:
+        return _settings['settings']
     try:
         # import user settings first
-        src = imp.load_source('settings', os.path.expanduser('~/.gips/settings.py'))
-        return src
+        src = imp.load_source('settings', userfile)
     except Exception, e:
         try:
             import gips.settings
-            return gips.settings
+            src = gips.settings
         except:
             raise Exception('No settings found...did you run gips_config?')
+    _settings['key'] = key
+    _settings['settings'] = src
+    return src
 
 
 def create_environment_settings(repos_path, email=''):
@@ -188,18 +212,23 @@ def create_repos():
 
 
 def data_sources():
-    """ Get enabled data sources (and verify) from settings """
+    """ Get enabled data sources (and verify) from settings, without importing the drivers """
+    from gips.data import drivers
     sources = {}
     repos = settings().REPOS
     found = False
     for key in sorted(repos.keys()):
         if os.path.isdir(repos[key]['repository']):
-            try:
-                repo = import_repository_class(key)
-                sources[key] = repo.description
-                found = True
-            except:
-                VerboseOut(traceback.format_exc(), 1)
+            # description from settings or manifest, only import driver if neither has one
+            desc = repos[key].get('description', '') or drivers.get(key, None)
+            if desc is None:
+                try:
+                    desc = import_repository_class(key).description
+                except:
+                    VerboseOut(traceback.format_exc(), 1)
+                    continue
+            sources[key] = desc
+            found = True
         else:
             raise Exception('ERROR: archive %s is not a directory or is not available' % key)
     if not found:
@@ -208,13 +237,17 @@ def data_sources():
 
 
 def import_data_module(clsname):
-    """ Import a data driver by name and return as module """
+    """ Import a data driver by name and return as module (loaded once, reloaded if driver changes) """
     import imp
     path = settings().REPOS[clsname].get('driver', '')
     if path == '':
         path = os.path.join( os.path.dirname(__file__), 'data', clsname, clsname + '.py') #__init__.py' )
+    key = (path, _mtime(path))
+    if clsname in _drivers and _drivers[clsname][0] == key:
+        return _drivers[clsname][1]
     try:
         mod = imp.load_source(clsname, path)
+        _drivers[clsname] = (key, mod)
         return mod
     except:
         print traceback.format_exc()
@@ -223,15 +256,13 @@ def import_data_module(clsname):
 def import_repository_class(clsname):
     """ Get clsnameRepository class object """
     mod = import_data_module(clsname)
-    exec('repo = mod.%sRepository' % clsname)
-    return repo
+    return getattr(mod, '%sRepository' % clsname)
 
 
 def import_data_class(clsname):
     """ Get clsnameData class object """
     mod = import_data_module(clsname)
-    exec('repo = mod.%sData' % clsname)
-    return repo    
+    return getattr(mod, '%sData' % clsname)
 
 
 ##############################################################################
@@ -240,6 +271,7 @@ def import_data_class(clsname):
 
 def open_vector(fname, key="", where=''):
     """ Open vector or feature """
+    from gippy import GeoVector
     parts = fname.split(':')
     if len(parts) == 1:
         vector = GeoVector(fname)
@@ -264,13 +296,11 @@ def open_vector(fname, key="", where=''):
     else:
         return vector
 
-from shapely.wkt import loads as wktloads
-from osr import SpatialReference, CoordinateTransformation
-from ogr import CreateGeometryFromWkt
-
 
 def transform_shape(shape, ssrs, tsrs):
     """ Transform shape from ssrs to tsrs (all wkt) and return as wkt """
+    from osr import SpatialReference, CoordinateTransformation
+    from ogr import CreateGeometryFromWkt
     ogrgeom = CreateGeometryFromWkt(shape)
     trans = CoordinateTransformation(SpatialReference(ssrs), SpatialReference(tsrs))
     ogrgeom.Transform(trans)
@@ -294,30 +324,96 @@ def transform(filename, srs):
     return fout
 
 
-def crop2vector(img, vector):
-    """ Crop a GeoImage down to a vector - only used by mosaic """
-    # transform vector to srs of image
-    vecname = transform(vector.Filename(), img.Projection())
-    warped_vec = open_vector(vecname)
-    # rasterize the vector
-    td = tempfile.mkdtemp()
-    mask = gippy.GeoImage(os.path.join(td, vector.LayerName()), img, gippy.GDT_Byte, 1)
-    maskname = mask.Filename()
-    mask = None
-    cmd = 'gdal_rasterize -at -burn 1 -l %s %s %s' % (warped_vec.LayerName(), vecname, maskname)
-    result = commands.getstatusoutput(cmd)
-    VerboseOut('%s: %s' % (cmd, result), 4)
-    mask = gippy.GeoImage(maskname)
-    img.AddMask(mask[0]).Process().ClearMasks()
-    mask = None
-    shutil.rmtree(os.path.dirname(maskname))
-    shutil.rmtree(os.path.dirname(vecname))
-    # VerboseOut('Cropped to vector in %s' % (datetime.now() - start), 3)
-    return img
+def rasterize(wkt, srs, geotransform, shape):
+    """ Rasterize geometry (wkt in srs) onto grid of shape (rows, cols), return array of 1 where
+    pixels touch the geometry and 0 elsewhere """
+    import gdal
+    import ogr
+    from osr import SpatialReference
+    from ogr import CreateGeometryFromWkt
+    ds = gdal.GetDriverByName('MEM').Create('', shape[1], shape[0], 1, gdal.GDT_Byte)
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(srs)
+    vds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = vds.CreateLayer('site', SpatialReference(srs))
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(CreateGeometryFromWkt(wkt))
+    layer.CreateFeature(feature)
+    gdal.RasterizeLayer(ds, [1], layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+    mask = ds.GetRasterBand(1).ReadAsArray()
+    feature = None
+    vds = None
+    ds = None
+    return mask
+
+
+# rasterized site masks, keyed by hash of geometry, projection, geotransform and size
+_masks = OrderedDict()
+_maxmasks = 16
+
+
+def site_mask(wkt, srs, geotransform, shape, cachedir=None):
+    """ Rasterize geometry (see rasterize), reusing masks of the same geometry and grid
+    kept in memory, or saved in cachedir (if given) by earlier runs """
+    key = hashlib.sha1(json.dumps([wkt, srs, list(geotransform), list(shape)])).hexdigest()
+    if key in _masks:
+        # most recently used last
+        _masks[key] = _masks.pop(key)
+        return _masks[key]
+    fname = os.path.join(cachedir, key + '.npy') if cachedir else None
+    if fname is not None and os.path.exists(fname):
+        mask = numpy.load(fname)
+    else:
+        mask = rasterize(wkt, srs, geotransform, shape)
+        if fname is not None:
+            # write to temporary file first so other processes never read a partial file
+            try:
+                mkdir(cachedir)
+                tmpfile = '%s.%s' % (fname, os.getpid())
+                with open(tmpfile, 'wb') as f:
+                    numpy.save(f, mask)
+                os.rename(tmpfile, fname)
+            except Exception, e:
+                VerboseOut('Unable to cache site mask: %s' % e, 2)
+    _masks[key] = mask
+    while len(_masks) > _maxmasks:
+        _masks.popitem(last=False)
+    return mask
+
+
+def _mosaic_window(tgt, tsize, sgt, ssize):
+    """ Window of source image (geotransform sgt, size ssize) within target image, as
+    ((target xoff, yoff, xsize, ysize), (source xoff, yoff, xsize, ysize)), None if no overlap """
+    # same as used by gdal_merge.py
+    t_lrx, t_lry = tgt[0] + tsize[0] * tgt[1], tgt[3] + tsize[1] * tgt[5]
+    s_lrx, s_lry = sgt[0] + ssize[0] * sgt[1], sgt[3] + ssize[1] * sgt[5]
+    ulx, lrx = max(tgt[0], sgt[0]), min(t_lrx, s_lrx)
+    if tgt[5] < 0:
+        uly, lry = min(tgt[3], sgt[3]), max(t_lry, s_lry)
+    else:
+        uly, lry = max(tgt[3], sgt[3]), min(t_lry, s_lry)
+    if ulx >= lrx or (tgt[5] < 0 and uly <= lry) or (tgt[5] > 0 and uly >= lry):
+        return None
+    tw_xoff = int((ulx - tgt[0]) / tgt[1] + 0.1)
+    tw_yoff = int((uly - tgt[3]) / tgt[5] + 0.1)
+    tw_xsize = int((lrx - tgt[0]) / tgt[1] + 0.5) - tw_xoff
+    tw_ysize = int((lry - tgt[3]) / tgt[5] + 0.5) - tw_yoff
+    sw_xoff = int((ulx - sgt[0]) / sgt[1])
+    sw_yoff = int((uly - sgt[3]) / sgt[5])
+    sw_xsize = int((lrx - sgt[0]) / sgt[1] + 0.5) - sw_xoff
+    sw_ysize = int((lry - sgt[3]) / sgt[5] + 0.5) - sw_yoff
+    if tw_xsize < 1 or tw_ysize < 1 or sw_xsize < 1 or sw_ysize < 1:
+        return None
+    return ((tw_xoff, tw_yoff, tw_xsize, tw_ysize), (sw_xoff, sw_yoff, sw_xsize, sw_ysize))
 
 
 def mosaic(images, outfile, vector):
-    """ Mosaic multiple files together, but do not warp """
+    """ Mosaic multiple files together and crop to vector, but do not warp.
+    The files are read and the output written in a single pass over windows of rows """
+    import gippy
+    import gdal
+    from ogr import CreateGeometryFromWkt
+    start = datetime.now()
     nd = images[0][0].NoDataValue()
     srs = images[0].Projection()
     # check they all have same projection
@@ -327,21 +423,169 @@ def mosaic(images, outfile, vector):
             raise Exception("Input files have non-matching projections and must be warped")
         filenames.append(images[f].Filename())
     # transform vector to image projection
-    geom = wktloads(transform_shape(vector.WKT(), vector.Projection(), srs))
-
-    extent = geom.bounds
-    ullr = "%f %f %f %f" % (extent[0], extent[3], extent[2], extent[1])
+    wkt = transform_shape(vector.WKT(), vector.Projection(), srs)
+    extent = CreateGeometryFromWkt(wkt).GetEnvelope()
+
+    # output grid covers vector with pixel size of first file
+    sources = [gdal.Open(f) for f in filenames]
+    gt0 = sources[0].GetGeoTransform()
+    xsize = int((extent[1] - extent[0]) / gt0[1] + 0.5)
+    ysize = int((extent[2] - extent[3]) / gt0[5] + 0.5)
+    gt = [extent[0], gt0[1], 0, extent[3], 0, gt0[5]]
+    windows = [_mosaic_window(gt, (xsize, ysize), ds.GetGeoTransform(), (ds.RasterXSize, ds.RasterYSize))
+               for ds in sources]
+    # same mask for all products and dates of a site
+    mask = site_mask(wkt, srs, gt, (ysize, xsize), getattr(settings(), 'MASKCACHE', '') or None)
+
+    numbands = sources[0].RasterCount
+    band0 = sources[0].GetRasterBand(1)
+    dsout = gdal.GetDriverByName('GTiff').Create(outfile, xsize, ysize, numbands, band0.DataType)
+    dsout.SetGeoTransform(gt)
+    dsout.SetProjection(srs)
+    dtype = band0.ReadAsArray(0, 0, 1, 1).dtype
+    rows = max(1, int(gippy.Options.ChunkSize() * 1024 * 1024 / (xsize * numbands * dtype.itemsize * 2.0)))
+    for y0 in range(0, ysize, rows):
+        height = min(rows, ysize - y0)
+        data = numpy.empty((numbands, height, xsize), dtype=dtype)
+        data[:] = nd
+        # later files are written over earlier ones, except where they have no data
+        for ds, window in zip(sources, windows):
+            if window is None:
+                continue
+            (txoff, tyoff, txsize, tysize), (sxoff, syoff, sxsize, sysize) = window
+            r0, r1 = max(y0, tyoff), min(y0 + height, tyoff + tysize)
+            if r0 >= r1:
+                continue
+            if sysize != tysize or sxsize != txsize:
+                # different pixel size, source rows nearest these rows (as GDAL resampling the whole window)
+                scale = sysize / float(tysize)
+                srows = numpy.array([min(int((r + 0.5) * scale), sysize - 1) for r in range(r0 - tyoff, r1 - tyoff)])
+                s0, numrows = srows[0], srows[-1] - srows[0] + 1
+            for b in range(0, numbands):
+                if sysize == tysize and sxsize == txsize:
+                    arr = ds.GetRasterBand(b + 1).ReadAsArray(sxoff, syoff + r0 - tyoff, sxsize, r1 - r0)
+                else:
+                    # read only those rows, resampled across
+                    arr = ds.GetRasterBand(b + 1).ReadAsArray(sxoff, syoff + int(s0), sxsize, int(numrows),
+                                                              txsize, int(numrows))[srows - s0]
+                valid = arr != nd
+                data[b, r0 - y0:r1 - y0, txoff:txoff + txsize][valid] = arr[valid]
+        data[:, mask[y0:y0 + height] == 0] = nd
+        for b in range(0, numbands):
+            dsout.GetRasterBand(b + 1).WriteArray(data[b], 0, y0)
+    for b in range(0, numbands):
+        dsout.GetRasterBand(b + 1).SetNoDataValue(nd)
+    dsout = None
+    sources = None
+    VerboseOut('%s: mosaicked %s files in %s' % (os.path.basename(outfile), len(filenames), datetime.now() - start), 4)
 
-    # run merge command
-    nodatastr = '-n %s -a_nodata %s -init %s' % (nd, nd, nd)
-    cmd = 'gdal_merge.py -o %s -ul_lr %s %s %s' % (outfile, ullr, nodatastr, " ".join(filenames))
-    result = commands.getstatusoutput(cmd)
-    VerboseOut('%s: %s' % (cmd, result), 4)
     imgout = gippy.GeoImage(outfile, True)
     for b in range(0, images[0].NumBands()):
         imgout[b].CopyMeta(images[0][b])
     imgout.CopyColorTable(images[0])
-    return crop2vector(imgout, vector)
+    return imgout
+
+
+def _site_cutline(site, dirname):
+    """ Write site geometry to a GeoJSON file in dirname (if not already) for use as a cutline, return filename """
+    import ogr
+    from osr import SpatialReference
+    from ogr import CreateGeometryFromWkt
+    fname = os.path.join(dirname, 'site_%s.geojson' % hashlib.sha1(site.WKT() + site.Projection()).hexdigest())
+    if not os.path.exists(fname):
+        # write to temporary file first so other processes never read a partial file
+        tmpfile = '%s.%s.geojson' % (os.path.splitext(fname)[0], os.getpid())
+        ds = ogr.GetDriverByName('GeoJSON').CreateDataSource(tmpfile)
+        layer = ds.CreateLayer('site', SpatialReference(site.Projection()))
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(CreateGeometryFromWkt(site.WKT()))
+        layer.CreateFeature(feature)
+        feature = None
+        ds = None
+        os.rename(tmpfile, fname)
+    return fname
+
+
+def gdal_utilities():
+    """ GDAL module, checking it has the Warp, Translate and BuildVRT utilities (GDAL >= 2.1) """
+    import gdal
+    if not hasattr(gdal, 'Warp'):
+        raise Exception('GDAL >= 2.1 is required (found %s)' % gdal.__version__)
+    return gdal
+
+
+def vrt_mosaic(images, outfile, site, res=None, interpolation=0):
+    """ Create VRT mosaic of images cropped to the site, warped to the site projection at res if given.
+    The VRT references the input files, intermediate VRTs are kept in .vrt/ alongside outfile """
+    import gippy
+    gdal = gdal_utilities()
+    filenames = [os.path.abspath(images[i].Filename()) for i in range(0, images.NumImages())]
+    outfile = os.path.abspath(outfile)
+    vrtdir = os.path.join(os.path.dirname(outfile), '.vrt')
+    mkdir(vrtdir)
+    nd = images[0][0].NoDataValue()
+    tiles = os.path.join(vrtdir, os.path.basename(outfile))
+    gdal.BuildVRT(tiles, filenames, srcNodata=nd, VRTNodata=nd)
+    opts = {'format': 'VRT', 'srcNodata': nd, 'dstNodata': nd,
+            'cutlineDSName': _site_cutline(site, vrtdir), 'cropToCutline': True}
+    if res is not None:
+        opts.update({'dstSRS': site.Projection(), 'xRes': res[0], 'yRes': res[1],
+                     'resampleAlg': ['near', 'bilinear', 'cubic'][interpolation]})
+    gdal.Warp(outfile, tiles, **opts)
+    imgout = gippy.GeoImage(outfile, True)
+    for b in range(0, images[0].NumBands()):
+        imgout[b].CopyMeta(images[0][b])
+    imgout.CopyColorTable(images[0])
+    return imgout
+
+
+def warp_bounds(filename, srs, res, numpoints=21):
+    """ Bounds (minx, miny, maxx, maxy) of file warped to srs, aligned to res, from points along its edges """
+    import gdal
+    from osr import SpatialReference, CoordinateTransformation
+    ds = gdal.Open(filename)
+    gt = ds.GetGeoTransform()
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    trans = CoordinateTransformation(SpatialReference(ds.GetProjection()), SpatialReference(srs))
+    ds = None
+    steps = [float(i) / (numpoints - 1) for i in range(0, numpoints)]
+    pixels = [(f * xsize, 0) for f in steps] + [(f * xsize, ysize) for f in steps] + \
+        [(0, f * ysize) for f in steps] + [(xsize, f * ysize) for f in steps]
+    points = trans.TransformPoints([(gt[0] + px * gt[1] + py * gt[2], gt[3] + px * gt[4] + py * gt[5])
+                                    for px, py in pixels])
+    xs = [pt[0] for pt in points]
+    ys = [pt[1] for pt in points]
+    # aligned to multiples of the resolution (as gdalwarp -tap)
+    return (math.floor(min(xs) / res[0]) * res[0], math.floor(min(ys) / res[1]) * res[1],
+            math.ceil(max(xs) / res[0]) * res[0], math.ceil(max(ys) / res[1]) * res[1])
+
+
+def warp(fin, fout, srs, res, interpolation=0, bounds=None, numthreads=2, format='GTiff'):
+    """ Warp file to srs at res (0-NN, 1-Bilinear, 2-Cubic interpolation) using numthreads threads.
+    Bounds (from warp_bounds) can be given to reuse the output grid of another file of the same tile """
+    import gippy
+    gdal = gdal_utilities()
+    if bounds is None:
+        bounds = warp_bounds(fin, srs, res)
+    resampler = ['near', 'bilinear', 'cubic']
+    gdal.Warp(fout, fin, format=format, dstSRS=srs, outputBounds=bounds, xRes=res[0], yRes=res[1],
+              resampleAlg=resampler[interpolation], multithread=True, warpOptions=['NUM_THREADS=%s' % numthreads])
+    img = gippy.GeoImage(fin)
+    imgout = gippy.GeoImage(fout, True)
+    for b in range(0, img.NumBands()):
+        imgout[b].CopyMeta(img[b])
+    imgout.CopyColorTable(img)
+    return imgout
+
+
+def chunks(img, numarrays=1, chunksize=None):
+    """ Split image into windows of whole rows so numarrays float32 arrays of a window fit in chunksize MB """
+    import gippy
+    if chunksize is None:
+        chunksize = gippy.Options.ChunkSize()
+    xsize, ysize = img.XSize(), img.YSize()
+    rows = max(1, int(chunksize * 1024 * 1024 / (xsize * numarrays * 4.0)))
+    return [gippy.Recti(0, y, xsize, min(rows, ysize - y)) for y in range(0, ysize, rows)]
 
 
 # old code utilizing shared memory array